@@ -1,7 +1,22 @@
+import argparse
+import heapq
+import csv
+import gc
+import inspect
+import json
 import math
+import os
 import random
 import sys
+import struct
+import tempfile
 import time
+import tracemalloc
+import zlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import Pipe, Process, shared_memory
+import numpy as np
 import pygame as pg
 WIDTH = 1600 # ゲームウィンドウの幅
 HEIGHT = 900 # ゲームウィンドウの高さ
@@ -31,6 +46,904 @@ def calc_orientation(org: pg.Rect, dst: pg.Rect) -> tuple[float, float]:
     return x_diff/norm, y_diff/norm
 
 
+def lerp(prev: tuple[int, int], now: tuple[int, int], alpha: float) -> tuple[float, float]:
+    """
+    前のティックの位置と現在の位置を補間した描画位置を返す
+    引数1 prev：前のティックの位置
+    引数2 now：現在の位置
+    引数3 alpha：前のティックから次のティックまでの経過割合（1.0なら現在の位置）
+    """
+    return prev[0]+(now[0]-prev[0])*alpha, prev[1]+(now[1]-prev[1])*alpha
+
+
+class Assets:
+    """
+    画像ファイルを一度だけ読み込み，変換済みの画像を使い回すクラス
+    回転・拡大・反転した画像も(パス, 角度, 倍率, 反転)をキーとして保持する
+    """
+    def __init__(self):
+        self.files = {}  # パス -> 読み込んだ画像Surface
+        self.fonts = {}  # 文字サイズ -> Font
+        self.strips = {}  # (パス, 効果, 最大枚数, 角度, 倍率) -> アニメーションの画像のリスト
+        self.masks = {}  # 画像Surface -> Mask
+        self.variants = {}  # (パス, 角度, 倍率, 反転) -> 変換済み画像Surface
+        self.atlas = None  # 弾・敵・爆発の画像を詰めたAtlas（packで作る）
+        self.reverse = {}  # 変換済み画像Surface -> variantsのキー
+        self.loads = 0  # ディスクから読み込んだ回数
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, path: str) -> pg.Surface:
+        """
+        画像ファイルを読み込み，画面のピクセル形式に変換して返す
+        一度読み込んだファイルは二度とディスクから読まない
+        引数 path：画像ファイルのパス
+        戻り値：画像Surface
+        """
+        img = self.files.get(path)
+        if img is None:
+            img = self.files[path] = self.convert(pg.image.load(path))
+            self.loads += 1
+        return img
+
+    @staticmethod
+    def convert(img: pg.Surface) -> pg.Surface:
+        """
+        読み込んだ画像を画面のピクセル形式に変換する（画面がなければそのまま）
+        """
+        if pg.display.get_surface() is None:  # 画面がないと変換できない
+            return img
+        if img.get_flags() & pg.SRCALPHA:
+            return img.convert_alpha()
+        return img.convert()  # カラーキーは保持される
+
+    def preload(self, manifest: dict, workers: int = None, progress=None) -> dict[str, float]:
+        """
+        ゲーム中に使う画像をまとめて作っておき，初めて使うときに止まらないようにする
+        ファイルの読み込み・デコードはスレッドプールで並列に行い，変換はメインスレッドで行う
+        引数1 manifest：ASSET_MANIFESTと同じ形の辞書
+        引数2 workers：読み込みに使うスレッド数（Noneならコア数に応じて決める）
+        引数3 progress：進み具合を受け取る関数 progress(済んだ数, 全体の数, 段階名)
+        戻り値：段階名 -> かかった時間[ms]（"files"は読み込んだファイル数）
+        """
+        folder = manifest["folder"]
+        paths = sorted(os.path.join(folder, name) for name in os.listdir(folder))
+        paths += [path for path in manifest["files"] if path not in paths]
+        paths = [path for path in paths if path not in self.files]
+        steps = [("fonts", manifest["fonts"], self.font),
+                 ("convert", paths, None),
+                 ("variants", manifest["images"], lambda args: self.image(*args)),
+                 ("strips", manifest["strips"], lambda args: self.strip(*args)),
+                 ("circles", manifest["circles"], lambda args: self.circle(*args))]
+        total = len(paths)+sum(len(items) for _, items, _ in steps)+1
+        done = 0
+        report = {"files": len(paths)}
+
+        def tick(name: str):
+            nonlocal done
+            done += 1
+            if progress is not None:
+                progress(done, total, name)
+
+        start = t = time.perf_counter()
+        with ThreadPoolExecutor(workers) as pool:
+            decoded = {}
+            for path, img in zip(paths, pool.map(pg.image.load, paths)):
+                decoded[path] = img
+                tick("decode")
+        now = time.perf_counter()
+        report["decode"], t = (now-t)*1000, now
+        for name, items, fn in steps:
+            for item in items:
+                if fn is None:  # convert
+                    self.files[item] = self.convert(decoded[item])
+                    self.loads += 1
+                else:
+                    fn(item)
+                tick(name)
+            now = time.perf_counter()
+            report[name], t = (now-t)*1000, now
+        if manifest["masks"]:
+            for img in list(self.variants.values())+[img for frames in self.strips.values() for img in frames]:
+                self.mask(img)
+        tick("masks")
+        now = time.perf_counter()
+        report["masks"], t = (now-t)*1000, now
+        self.pack(manifest)
+        now = time.perf_counter()
+        report["atlas"] = (now-t)*1000
+        report["total"] = (now-start)*1000
+        return report
+
+    def image(self, path: str, angle: float = 0, scale: float = 1.0,
+              flip: tuple[bool, bool] = (False, False)) -> pg.Surface:
+        """
+        反転・回転・拡大した画像を返す
+        引数1 path：画像ファイルのパス
+        引数2 angle：回転角度
+        引数3 scale：拡大率
+        引数4 flip：横方向，縦方向の反転の真理値タプル
+        戻り値：変換済み画像Surface
+        """
+        key = (path, angle, scale, flip)
+        img = self.variants.get(key)
+        if img is not None:
+            self.hits += 1
+            return img
+        self.misses += 1
+        img = self.load(path)
+        if flip != (False, False):
+            img = pg.transform.flip(img, *flip)
+        if angle != 0 or scale != 1.0:
+            img = pg.transform.rotozoom(img, angle, scale)
+        self.variants[key] = img
+        return img
+
+    def key(self, img: pg.Surface) -> tuple:
+        """
+        引数 img：imageまたはcircleが返した画像Surface
+        戻り値：その画像のvariantsのキー（by_keyで同じ画像を引ける）
+        """
+        if len(self.reverse) != len(self.variants):
+            self.reverse = {img: key for key, img in self.variants.items()}
+        return self.reverse[img]
+
+    def by_key(self, key: list) -> pg.Surface:
+        """
+        引数 key：keyが返したキー（JSONを通してタプルがリストになっていてもよい）
+        戻り値：キーの画像Surface（なければ作る）
+        """
+        if key[0] == "circle":
+            return self.circle(key[1], tuple(key[2]))
+        return self.image(key[0], key[1], key[2], tuple(key[3]))
+
+    effects = {  # アニメーションを作る効果
+        "laplacian": pg.transform.laplacian,
+        "flip": lambda img: pg.transform.flip(img, True, True),
+    }
+
+    def strip(self, path: str, effect: str, count: int, angle: float = 0, scale: float = 1.0) -> list[pg.Surface]:
+        """
+        画像に効果を繰り返しかけたアニメーションの画像のリストを，初めて使うときに一度だけ作って返す
+        i番目の画像は効果をi回かけたもので，効果をかけても画像が変わらなくなったらそこで打ち切る
+        引数1 path：画像ファイルのパス
+        引数2 effect：effectsの効果名
+        引数3 count：最大枚数
+        引数4 angle：回転角度
+        引数5 scale：拡大率
+        戻り値：画像Surfaceのリスト
+        """
+        key = (path, effect, count, angle, scale)
+        frames = self.strips.get(key)
+        if frames is not None:
+            self.hits += 1
+            return frames
+        self.misses += 1
+        frames = self.strips[key] = [self.image(path, angle, scale)]
+        fn = self.effects[effect]
+        while len(frames) < count:
+            img = fn(frames[-1])
+            if pg.image.tobytes(img, "RGBA") == pg.image.tobytes(frames[-1], "RGBA"):
+                break
+            frames.append(img)
+        return frames
+
+    def circle(self, rad: int, color: tuple[int, int, int]) -> pg.Surface:
+        """
+        引数1 rad：円の半径
+        引数2 color：円の色
+        戻り値：(半径, 色)ごとに一度だけ描画した円Surface
+        """
+        key = ("circle", rad, color)
+        img = self.variants.get(key)
+        if img is not None:
+            self.hits += 1
+            return img
+        self.misses += 1
+        img = self.variants[key] = pg.Surface((2*rad, 2*rad))
+        pg.draw.circle(img, color, (rad, rad), rad)
+        img.set_colorkey((0, 0, 0))
+        return img
+
+    def mask(self, img: pg.Surface) -> pg.mask.Mask:
+        """
+        引数 img：画像Surface（Assetsが返したもの）
+        戻り値：画像ごとに一度だけ作ったMask
+        """
+        mask = self.masks.get(img)
+        if mask is None:
+            mask = self.masks[img] = pg.mask.from_surface(img)
+        return mask
+
+    def swept_mask(self, img: pg.Surface, dx: int, dy: int) -> pg.mask.Mask:
+        """
+        引数1 img：画像Surface（Assetsが返したもの）
+        引数2 dx，dy：1ティックの移動量
+        戻り値：画像を前の位置から今の位置まで動かしたときに通る範囲のMask（組み合わせごとに一度だけ作る）
+        左上は，前の位置と今の位置の画像を囲むRectの左上
+        """
+        key = (img, dx, dy)
+        mask = self.masks.get(key)
+        if mask is None:
+            # 前の位置から今の位置まで1ピクセルずつずらして画像のMaskを重ねる
+            base = self.mask(img)
+            mask = self.masks[key] = pg.mask.Mask((img.get_width()+abs(dx), img.get_height()+abs(dy)))
+            x0, y0, x1, y1 = max(-dx, 0), max(-dy, 0), max(dx, 0), max(dy, 0)
+            steps = max(abs(dx), abs(dy), 1)
+            for t in range(steps+1):
+                mask.draw(base, (x0+round((x1-x0)*t/steps), y0+round((y1-y0)*t/steps)))
+        return mask
+
+    def pack(self, manifest: dict) -> "Atlas":
+        """
+        manifest["atlas"]で指定した画像と爆弾の円を作り，Atlasに詰めてself.atlasにする
+        引数 manifest：ASSET_MANIFESTと同じ形の辞書
+        戻り値：作ったAtlas
+        """
+        spec = manifest["atlas"]
+        imgs = [self.image(*args) for args in spec["images"]]
+        imgs += [img for args in spec["strips"] for img in self.strip(*args)]
+        imgs += [self.circle(*args) for args in manifest["circles"]]
+        self.atlas = Atlas(imgs, spec["width"])
+        return self.atlas
+
+    def clear(self):
+        """
+        作った画像・アニメーション・Mask・Atlasを捨てる（読み込んだファイルとフォントは残す）
+        """
+        self.strips = {}
+        self.masks = {}
+        self.variants = {}
+        self.reverse = {}
+        self.atlas = None
+
+    def font(self, size: int) -> pg.font.Font:
+        """
+        引数 size：文字サイズ
+        戻り値：文字サイズごとに一度だけ生成したFont
+        """
+        font = self.fonts.get(size)
+        if font is None:
+            font = self.fonts[size] = pg.font.Font(None, size)
+        return font
+
+    def stats(self) -> dict[str, int]:
+        """
+        戻り値：読み込み回数，ヒット数，ミス数，保持している画像数の辞書
+        """
+        return {
+            "loads": self.loads,
+            "hits": self.hits,
+            "misses": self.misses,
+            "variants": len(self.variants),
+        }
+
+
+class Atlas:
+    """
+    弾・敵・爆発の画像を，ピクセル形式（透明度の持ち方）ごとに数枚の大きな画像（ページ）に詰めて持つクラス
+    元の画像から(ページ, 範囲)を引けるので，同じ種類の弾や敵は範囲付きの1回のblitsで描画でき，
+    描画元のSurfaceが数枚にまとまる
+    """
+    def __init__(self, imgs: list[pg.Surface], width: int = 256):
+        """
+        高さの順に並べた画像を，左から右へ，はみ出したら次の段へと詰める
+        ページの幅が広いと1行が離れて並ぶので描画が遅くなる（幅1024では2～3割遅かった）
+        引数1 imgs：詰める画像Surfaceのリスト（重複してよい）
+        引数2 width：ページの幅（これより広い画像があるページはその画像の幅にする）
+        """
+        self.areas = {}  # 元の画像Surface -> (ページ, 範囲Rect)
+        self.pages = []
+        groups = {}  # ピクセル形式 -> 画像のリスト
+        for img in dict.fromkeys(imgs):
+            groups.setdefault((img.get_flags() & pg.SRCALPHA, img.get_colorkey()), []).append(img)
+        for (alpha, colorkey), items in groups.items():
+            items.sort(key=lambda img: (-img.get_height(), -img.get_width()))
+            page_width = max(width, *(img.get_width() for img in items))
+            places = []
+            x = y = row = 0
+            for img in items:
+                w, h = img.get_size()
+                if x+w > page_width:
+                    x, y, row = 0, y+row, 0
+                places.append(pg.Rect(x, y, w, h))
+                x += w
+                row = max(row, h)
+            page = pg.Surface((page_width, y+row), alpha, items[0])
+            if colorkey is not None:
+                page.fill(colorkey)
+                page.set_colorkey(colorkey)
+            for img, area in zip(items, places):
+                page.blit(img, area, special_flags=pg.BLEND_RGBA_MAX if alpha else 0)
+                self.areas[img] = page, area
+            self.pages.append(page)
+
+    def lookup(self, img: pg.Surface) -> tuple[pg.Surface, pg.Rect]:
+        """
+        戻り値：画像imgを描画するときの(描画元Surface, 範囲Rect)（詰めていない画像はその画像全体）
+        """
+        found = self.areas.get(img)
+        return found if found is not None else (img, img.get_rect())
+
+
+ASSETS = Assets()
+
+
+class SpriteGrid:
+    """
+    スプライトのグループを一様グリッドに振り分けたもの
+    """
+    def __init__(self, group: pg.sprite.AbstractGroup, cell: int):
+        """
+        引数1 group：振り分けるグループ
+        引数2 cell：グリッドの1マスの大きさ
+        """
+        self.group = group
+        self.cell = cell
+        self.buckets = {}  # マス -> スプライトのリスト
+        for sprite in group:
+            for key in self.cells(sprite.rect):
+                bucket = self.buckets.get(key)
+                if bucket is None:
+                    self.buckets[key] = [sprite]
+                else:
+                    bucket.append(sprite)
+
+    def cells(self, rect: pg.Rect):
+        """
+        引数 rect：スプライトのRect
+        戻り値：rectが重なるマスのイテレータ
+        """
+        c = self.cell
+        for cx in range(rect.left//c, (rect.right-1)//c+1):
+            for cy in range(rect.top//c, (rect.bottom-1)//c+1):
+                yield cx, cy
+
+    def __len__(self):
+        return len(self.group)
+
+    def items(self) -> list:
+        return [sprite for sprite in self.group if sprite.alive()]
+
+    def query(self, rect: pg.Rect) -> tuple[list, int]:
+        """
+        引数 rect：調べる範囲のRect
+        戻り値：rectと重なる生きているスプライトのリストと，重なりを調べた回数のタプル
+        """
+        found = []
+        seen = set()
+        for key in self.cells(rect):
+            for sprite in self.buckets.get(key, ()):
+                if sprite not in seen and sprite.alive():
+                    seen.add(sprite)
+                    if rect.colliderect(sprite.rect):
+                        found.append(sprite)
+        return found, len(seen)
+
+
+class Collisions:
+    """
+    衝突判定に関するクラス
+    登録したグループ（スプライトのGroup・ActorView，またはProjectiles・ProjectileView）を1フレームに1回だけ
+    一様グリッドに振り分け，グループの組ごとの衝突判定をすべてそのグリッドから求める
+    当たったものの組は，組ごとに登録した処理関数に渡す
+    preciseがTrueなら，Rect（円）で当たったものの組をさらに画像のMaskで判定し直す
+    掃引する弾は，移動範囲全体をなぞったMaskで判定する
+    当たっても消えない（貫通する）ものは，同じ相手に二度当たらないよう当たった相手を覚えておく
+    """
+    def __init__(self, cell: int = 128, precise: bool = False):
+        """
+        引数1 cell：グリッドの1マスの大きさ
+        引数2 precise：Maskで判定し直すか
+        """
+        self.cell = cell
+        self.precise = precise
+        self.groups = {}  # グループ名 -> Group・ActorViewまたはProjectiles・ProjectileView
+        self.pairs = []  # (グループ名a, グループ名b, aを消すか, bを消すか, 処理関数)
+        self.grids = {}  # グループ名 -> SpriteGridまたは索引を作ったProjectiles
+        self.checks = 0  # 重なりを調べた回数
+        self.mask_checks = 0  # Maskの重なりを調べた回数
+        self.pierced = {}  # 貫通したもののキー -> すでに当たった相手のキーの集合
+
+    def add_group(self, name: str, group: "pg.sprite.AbstractGroup|ActorView|Projectiles|ProjectileView"):
+        self.groups[name] = group
+
+    def add_pair(self, a: str, b: str, kill_a: bool, kill_b: bool, handler):
+        """
+        衝突判定するグループの組と，当たったときの処理を登録する
+        引数1 a：グループ名
+        引数2 b：グループ名
+        引数3 kill_a：当たったaを消すか
+        引数4 kill_b：当たったbを消すか
+        引数5 handler：aのスプライト（弾の場合はProjectile）と，それに当たったbのリストを受け取る関数
+        """
+        self.pairs.append((a, b, kill_a, kill_b, handler))
+
+    def overlap(self, a, b) -> bool:
+        """
+        Rect（円）が重なっているaとbの，画像の不透明な部分が重なっているかをMaskで調べる
+        """
+        self.mask_checks += 1
+        mask_a = a.mask if hasattr(a, "mask") else ASSETS.mask(a.image)
+        mask_b = b.mask if hasattr(b, "mask") else ASSETS.mask(b.image)
+        return mask_a.overlap(mask_b, (b.rect.x-a.rect.x, b.rect.y-a.rect.y)) is not None
+
+    @staticmethod
+    def key(obj) -> "int|pg.sprite.Sprite":
+        """
+        戻り値：当たった相手を覚えておくためのキー（弾は通し番号，スプライトはそのもの）
+        """
+        return getattr(obj, "uid", obj)
+
+    def first_hit(self, sa, sb) -> bool:
+        """
+        貫通するsbがsaに初めて当たったならそれを覚えてTrue，前にも当たっていたらFalseを返す
+        """
+        hit = self.pierced.setdefault(self.key(sb), set())
+        ka = self.key(sa)
+        if ka in hit:
+            return False
+        hit.add(ka)
+        return True
+
+    def build(self):
+        """
+        組に使われているグループをすべてグリッドに振り分ける
+        同じProjectilesの種類ごとのProjectileViewは，Projectilesの索引を1つだけ作って共有する
+        """
+        self.grids = {}
+        used = {name for a, b, *_ in self.pairs for name in (a, b)}
+        indexed = {}  # id(Projectiles) -> 索引を作ったProjectiles
+        for name, group in self.groups.items():
+            if name not in used:
+                continue
+            if isinstance(group, (Projectiles, ProjectileView)):
+                store = getattr(group, "store", group)
+                if id(store) not in indexed:
+                    store.index(self.cell)
+                    indexed[id(store)] = store
+                self.grids[name] = group
+            else:
+                self.grids[name] = SpriteGrid(group, self.cell)
+        if self.pierced:  # 消えたものと，当たった相手のうち消えたものは忘れる
+            # 覚えている弾の通し番号だけを，生きている弾の通し番号から探す
+            keys = [k for k, hit in self.pierced.items() for k in (k, *hit) if isinstance(k, int)]
+            uids = set()
+            for store in indexed.values():
+                found = np.isin(keys, store.uid[:store.n][store.live[:store.n]])
+                uids.update(k for k, live in zip(keys, found.tolist()) if live)
+
+            def alive(k) -> bool:
+                return k in uids if isinstance(k, int) else k.alive()
+            self.pierced = {k: {h for h in hit if alive(h)} for k, hit in self.pierced.items() if alive(k)}
+
+    def collide(self, a: str, b: str, kill_a: bool, kill_b: bool) -> dict:
+        """
+        pg.sprite.groupcollideとほぼ同じ結果をグリッドから求める
+        数の少ない方のグループから，もう一方のグリッドを引く
+        aもbも消えない組だけ，同じ相手に二度当たらないよう当たった相手を覚えておく
+        戻り値：aのスプライト -> 当たったbのリスト の辞書
+        """
+        grid_a, grid_b = self.grids[a], self.grids[b]
+        once = not kill_a and not kill_b
+        hits = {}
+        len_a, len_b = len(grid_a), len(grid_b)
+        if len_a == 0 or len_b == 0:
+            return hits
+        if len_a <= len_b:
+            for sa in grid_a.items():
+                found, checks = grid_b.query(sa.rect)
+                self.checks += checks
+                if found and self.precise:
+                    found = [sb for sb in found if self.overlap(sa, sb)]
+                if found and once:
+                    found = [sb for sb in found if self.first_hit(sa, sb)]
+                if found:
+                    hits[sa] = found
+                    if kill_b:
+                        for sb in found:
+                            sb.kill()
+        else:
+            for sb in grid_b.items():
+                found, checks = grid_a.query(sb.rect)
+                self.checks += checks
+                for sa in found:
+                    if self.precise and not self.overlap(sa, sb):
+                        continue
+                    if once and not self.first_hit(sa, sb):
+                        continue
+                    hits.setdefault(sa, []).append(sb)
+                    if kill_b:  # 消えるものは最初に当たった1つにだけ当たる
+                        sb.kill()
+                        break
+        return hits
+
+    def run(self):
+        """
+        グリッドを作り直し，登録した組の順に衝突判定と処理を行う
+        """
+        self.build()
+        for a, b, kill_a, kill_b, handler in self.pairs:
+            for sa, sbs in self.collide(a, b, kill_a, kill_b).items():
+                if kill_a:
+                    sa.kill()
+                handler(sa, sbs)
+
+
+class Projectile:
+    """
+    Projectilesの配列で管理している弾1つを指すクラス
+    衝突判定の処理関数にスプライトの代わりに渡す
+    rectは衝突判定に使う範囲（掃引する弾なら前のティックからの移動範囲全体）
+    """
+    __slots__ = ("store", "i", "rect")
+
+    def __init__(self, store: "Projectiles", i: int):
+        self.store = store
+        self.rect = pg.Rect(0, 0, 0, 0)
+        self.reset(i)
+
+    def reset(self, i: int):
+        store = self.store
+        self.i = i
+        self.rect.update(int(store.sx[i]), int(store.sy[i]), int(store.sw[i]), int(store.sh[i]))
+
+    @property
+    def image(self) -> pg.Surface:
+        return self.store.images[self.store.img[self.i]]
+
+    @property
+    def kind(self) -> str:
+        return self.store.kinds[self.store.kind[self.i]]
+
+    @property
+    def uid(self) -> int:
+        return int(self.store.uid[self.i])
+
+    @property
+    def mask(self) -> pg.mask.Mask:
+        """
+        rectの位置に置くMask（掃引する弾は前の位置から今の位置まで画像をなぞったもの）
+        """
+        store, i = self.store, self.i
+        if store.sweep[i]:
+            return ASSETS.swept_mask(self.image, int(store.dx[i]), int(store.dy[i]))
+        return ASSETS.mask(self.image)
+
+    def alive(self) -> bool:
+        return bool(self.store.live[self.i])
+
+    def kill(self):
+        store = self.store
+        if store.live[self.i]:
+            store.live[self.i] = False
+            store.counts[store.kind[self.i]] -= 1
+
+
+class Projectiles:
+    """
+    爆弾・ビームをNumPy配列（構造体の配列ではなく配列の構造体）でまとめて管理するクラス
+    種類の違う弾も1つの配列に入れ，移動・寿命・画面外判定・当たり判定を配列演算で一度に行う
+    円の弾（半径が正）は円で，それ以外はRectで当たり判定する
+    掃引する種類のRectの弾は，前のティックの位置から今の位置までの範囲全体で当たり判定する
+    （速い弾が薄い相手をすり抜けないようにする．出たばかりでまだ動いていない弾は掃引しない）
+    """
+    def __init__(self, capacity: int = 256, kinds: list[str] = ("shot",), swept: list[str] = ()):
+        """
+        引数1 capacity：最初に確保しておく弾の数
+        引数2 kinds：弾の種類名のリスト（種類はこのリストの番号で持つ）
+        引数3 swept：掃引して当たり判定する種類名のリスト
+        """
+        self.kinds = list(kinds)
+        self.kind_ids = {name: k for k, name in enumerate(self.kinds)}
+        self.swept = np.array([name in swept for name in self.kinds], np.bool_)  # 種類 -> 掃引するか
+        self.next_uid = 0  # 次に追加する弾の通し番号
+        self.counts = [0]*len(self.kinds)  # 種類ごとの生きている弾の数
+        self.n = 0  # 使っている要素数
+        self.images = []  # 画像番号 -> 画像Surface
+        self.image_ids = {}  # 画像Surface -> 画像番号
+        self.allocs = 0  # 配列を確保した回数
+        self.alloc(capacity)
+        self.refs = {}  # 要素番号 -> Projectile
+        self.spare = []  # 再利用するProjectile
+        self.ref_allocs = 0  # Projectileを新しく生成した回数
+        self.order = self.keys = None
+        self.cell = 1
+        self.cols = 1
+        self.reach = 0
+        self.reaches = [0]*len(self.kinds)
+        self.atlas = None  # areasを作ったときのAtlas
+        self.areas = []  # 画像番号 -> Atlasの(ページ, 範囲)
+
+    def alloc(self, capacity: int):
+        """
+        配列をcapacity個分確保し，使っている要素を移す
+        """
+        n = self.n
+        old = getattr(self, "x", None)
+        arrays = {}
+        for name, dtype in [("x", np.int32), ("y", np.int32), ("w", np.int32), ("h", np.int32),
+                            ("dx", np.int32), ("dy", np.int32), ("rad", np.int32), ("img", np.int32),
+                            ("kind", np.int8), ("life", np.int32), ("uid", np.int64), ("live", np.bool_),
+                            ("moved", np.bool_)]:
+            arr = np.zeros(capacity, dtype)
+            if old is not None:
+                arr[:n] = getattr(self, name)[:n]
+            arrays[name] = arr
+        self.__dict__.update(arrays)
+        self.capacity = capacity
+        self.allocs += 1
+
+    def __len__(self):
+        return int(np.count_nonzero(self.live[:self.n]))
+
+    def add(self, rect: pg.Rect, dx: float, dy: float, image: pg.Surface, rad: int = 0, kind: int = 0,
+            life: int = -1):
+        """
+        弾を1つ追加する
+        引数1 rect：弾のRect
+        引数2 dx，dy：1フレームの移動量（Rect.move_ipと同じく整数に切り捨てる）
+        引数3 image：弾の画像Surface
+        引数4 rad：円の弾の半径（0ならRectで当たり判定する）
+        引数5 kind：弾の種類の番号
+        引数6 life：弾の寿命のティック数（負なら画面外に出るまで消えない）
+        """
+        if self.n == self.capacity:
+            self.alloc(self.capacity*2)
+        img = self.image_id(image)
+        i = self.n
+        self.x[i], self.y[i], self.w[i], self.h[i] = rect
+        self.dx[i], self.dy[i] = int(dx), int(dy)
+        self.rad[i] = rad
+        self.img[i] = img
+        self.kind[i] = kind
+        self.life[i] = life
+        self.uid[i] = self.next_uid
+        self.live[i] = True
+        self.moved[i] = False
+        self.counts[kind] += 1
+        self.next_uid += 1
+        self.n += 1
+
+    def add_many(self, cx: float, cy: float, dx: np.ndarray, dy: np.ndarray, image: pg.Surface, rad: int = 0,
+                 kind: int = 0, life: int = -1):
+        """
+        同じ画像・種類の弾をまとめて追加する
+        引数1 cx，cy：弾の中心（数値または配列）
+        引数2 dx，dy：1フレームの移動量の配列（addと同じく0の方向に切り捨てる）
+        引数3 image：弾の画像Surface
+        引数4 rad：円の弾の半径
+        引数5 kind：弾の種類の番号
+        引数6 life：弾の寿命のティック数
+        """
+        m = len(dx)
+        end = self.n+m
+        if end > self.capacity:
+            capacity = self.capacity
+            while capacity < end:
+                capacity *= 2
+            self.alloc(capacity)
+        w, h = image.get_size()
+        s = slice(self.n, end)
+        self.x[s] = np.asarray(cx, np.int32)-w//2
+        self.y[s] = np.asarray(cy, np.int32)-h//2
+        self.w[s], self.h[s] = w, h
+        self.dx[s] = dx  # float -> int32は0の方向に切り捨てられる
+        self.dy[s] = dy
+        self.rad[s] = rad
+        self.img[s] = self.image_id(image)
+        self.kind[s] = kind
+        self.life[s] = life
+        self.uid[s] = np.arange(self.next_uid, self.next_uid+m)
+        self.live[s] = True
+        self.moved[s] = False
+        self.counts[kind] += m
+        self.next_uid += m
+        self.n = end
+
+    def image_id(self, image: pg.Surface) -> int:
+        """
+        戻り値：画像の番号（初めての画像なら登録する）
+        """
+        img = self.image_ids.get(image)
+        if img is None:
+            img = self.image_ids[image] = len(self.images)
+            self.images.append(image)
+        return img
+
+    def compact(self):
+        """
+        消えた弾を詰めて，生きている弾を配列の先頭に並べる
+        """
+        n = self.n
+        live = self.live[:n]
+        if live.all():
+            return
+        keep = np.flatnonzero(live)
+        m = len(keep)
+        for arr in (self.x, self.y, self.w, self.h, self.dx, self.dy, self.rad, self.img, self.kind, self.life,
+                    self.uid, self.moved):
+            arr[:m] = arr[keep]
+        self.live[:m] = True
+        self.live[m:n] = False
+        self.n = m
+
+    def update(self):
+        """
+        全ての弾を移動量に基づき移動させ，寿命が尽きた弾と画面外に出た弾を消す
+        """
+        self.compact()
+        n = self.n
+        if n == 0:
+            return
+        x, y, life = self.x[:n], self.y[:n], self.life[:n]
+        x += self.dx[:n]
+        y += self.dy[:n]
+        life -= life > 0
+        self.moved[:n] = True
+        self.live[:n] = (x >= 0) & (x+self.w[:n] <= WIDTH) & (y >= 0) & (y+self.h[:n] <= HEIGHT) & (life != 0)
+        self.compact()
+        self.counts = np.bincount(self.kind[:self.n], minlength=len(self.kinds)).tolist()
+
+    def count(self, name: str) -> int:
+        """
+        戻り値：種類nameの生きている弾の数
+        """
+        return self.counts[self.kind_ids[name]]
+
+    def view(self, name: str) -> "ProjectileView":
+        """
+        戻り値：種類nameの弾だけを1つのグループのように扱うもの（衝突判定用）
+        """
+        return ProjectileView(self, self.kind_ids[name])
+
+    def draw(self, screen: pg.Surface, alpha: float = 1.0):
+        """
+        全ての弾を描画する
+        引数1 screen：画面Surface
+        引数2 alpha：前のティックから次のティックまでの経過割合（前の位置は移動量から求める）
+        ASSETS.atlasがあれば，画像の代わりにAtlasのページの範囲を描画する
+        """
+        n = self.n
+        x, y = self.x[:n], self.y[:n]
+        if alpha < 1.0:
+            x = x-(self.dx[:n]*(1.0-alpha)).astype(np.int32)
+            y = y-(self.dy[:n]*(1.0-alpha)).astype(np.int32)
+        live = zip(self.img[:n].tolist(), x.tolist(), y.tolist(), self.live[:n].tolist())
+        atlas = ASSETS.atlas
+        if atlas is None:
+            imgs = self.images
+            screen.blits([(imgs[i], (x, y)) for i, x, y, alive in live if alive], doreturn=False)
+            return
+        # 画像番号 -> (ページ, 範囲)
+        if len(self.areas) < len(self.images) or self.atlas is not atlas:
+            self.atlas = atlas
+            self.areas = [atlas.lookup(img) for img in self.images]
+        areas = self.areas
+        screen.blits([(areas[i][0], (x, y), areas[i][1]) for i, x, y, alive in live if alive], doreturn=False)
+
+    def index(self, cell: int):
+        """
+        当たり判定の範囲（掃引する弾は前のティックの位置から今の位置まで）を求め，
+        その中心があるマスの番号で要素番号をソートした索引を作る
+        引数 cell：グリッドの1マスの大きさ
+        """
+        n = self.n
+        self.spare.extend(self.refs.values())
+        self.refs.clear()
+        self.cell = cell
+        self.cols = WIDTH//cell+3
+        if n == 0:
+            self.order = self.keys = np.zeros(0, np.intp)
+            self.sx = self.sy = self.sw = self.sh = self.sweep = np.zeros(0, np.int32)
+            self.reach = 0
+            self.reaches = [0]*len(self.kinds)
+            return
+        # 前の位置は今の位置から移動量を引いたところ（円の弾と，出たばかりでまだ動いていない弾は掃引しない）
+        sweep = self.sweep = self.swept[self.kind[:n]] & (self.rad[:n] == 0) & self.moved[:n]
+        dx = np.where(sweep, self.dx[:n], 0)
+        dy = np.where(sweep, self.dy[:n], 0)
+        self.sx = self.x[:n]-np.maximum(dx, 0)
+        self.sy = self.y[:n]-np.maximum(dy, 0)
+        self.sw = self.w[:n]+np.abs(dx)
+        self.sh = self.h[:n]+np.abs(dy)
+        # 画面外のマスは端のマスにまとめる
+        cx = np.minimum(np.maximum((self.sx+self.sw//2)//cell+1, 0), self.cols-1)
+        cy = np.minimum(np.maximum((self.sy+self.sh//2)//cell+1, 0), HEIGHT//cell+2)
+        keys = cy*self.cols+cx
+        self.order = np.argsort(keys, kind="stable")
+        self.keys = keys[self.order]
+        # 中心のマスから何マス先まで弾がはみ出しうるか（全体と種類ごと）
+        half = np.zeros(len(self.kinds), np.int32)
+        np.maximum.at(half, self.kind[:n], np.maximum(self.sw, self.sh)//2)
+        self.reaches = (-(-half//cell)).tolist()
+        self.reach = max(self.reaches)
+
+    def ref(self, i: int) -> Projectile:
+        p = self.refs.get(i)
+        if p is None:
+            if self.spare:
+                p = self.spare.pop()
+                p.reset(i)
+            else:
+                p = Projectile(self, i)
+                self.ref_allocs += 1
+            self.refs[i] = p
+        return p
+
+    def stats(self) -> dict[str, int]:
+        """
+        戻り値：弾の数，確保している要素数，配列・Projectileを新しく確保した回数の辞書
+        """
+        return {"count": len(self), "capacity": self.capacity, "allocs": self.allocs,
+                "ref_allocs": self.ref_allocs}
+
+    def items(self, kind: int = None) -> list[Projectile]:
+        """
+        引数 kind：種類の番号（Noneならすべての種類）
+        戻り値：生きている弾のリスト
+        """
+        live = self.live[:self.n]
+        if kind is not None:
+            live = live & (self.kind[:self.n] == kind)
+        return [self.ref(i) for i in np.flatnonzero(live).tolist()]
+
+    def query(self, rect: pg.Rect, kind: int = None) -> tuple[list[Projectile], int]:
+        """
+        引数1 rect：調べる範囲のRect
+        引数2 kind：種類の番号（Noneならすべての種類）
+        戻り値：rectと重なる生きている弾のリストと，重なりを調べた回数のタプル
+        """
+        c = self.cell
+        r = self.reach if kind is None else self.reaches[kind]
+        x0 = max(rect.left//c+1-r, 0)
+        x1 = min((rect.right-1)//c+1+r, self.cols-1)
+        y0 = max(rect.top//c+1-r, 0)
+        y1 = min((rect.bottom-1)//c+1+r, HEIGHT//c+2)
+        if x0 > x1 or y0 > y1:
+            return [], 0
+        rows = np.arange(y0, y1+1)*self.cols
+        lo = np.searchsorted(self.keys, rows+x0)
+        hi = np.searchsorted(self.keys, rows+x1, "right")
+        cand = np.concatenate([self.order[a:b] for a, b in zip(lo.tolist(), hi.tolist())])
+        if kind is None:
+            cand = cand[self.live[cand]]
+        else:
+            cand = cand[self.live[cand] & (self.kind[cand] == kind)]
+        if len(cand) == 0:
+            return [], 0
+        x, y, w, h, rad = self.sx[cand], self.sy[cand], self.sw[cand], self.sh[cand], self.rad[cand]
+        hit = (x < rect.right) & (rect.left < x+w) & (y < rect.bottom) & (rect.top < y+h)
+        # 円の弾は，円の中心に最も近いrect内の点との距離で判定する
+        circle = rad > 0
+        if circle.any():
+            cx, cy = x+rad, y+rad
+            nx = np.minimum(np.maximum(cx, rect.left), rect.right-1)-cx
+            ny = np.minimum(np.maximum(cy, rect.top), rect.bottom-1)-cy
+            hit &= ~circle | (nx*nx+ny*ny < rad*rad)
+        return [self.ref(i) for i in cand[hit].tolist()], len(cand)
+
+
+class ProjectileView:
+    """
+    Projectilesのうち1つの種類の弾を，衝突判定で1つのグループとして扱うためのクラス
+    """
+    __slots__ = ("store", "kind")
+
+    def __init__(self, store: Projectiles, kind: int):
+        self.store = store
+        self.kind = kind
+
+    def __len__(self):
+        return self.store.counts[self.kind]
+
+    def items(self) -> list[Projectile]:
+        return self.store.items(self.kind)
+
+    def query(self, rect: pg.Rect) -> tuple[list[Projectile], int]:
+        return self.store.query(rect, self.kind)
+
+
 class Aircraft(pg.sprite.Sprite):
     """
     戦闘機に関するクラス
@@ -47,13 +960,16 @@ class Aircraft(pg.sprite.Sprite):
         引数1 xy：戦闘機画像の位置座標タプル
         """
         super().__init__()
-        self.img = pg.transform.rotozoom(pg.image.load(f"ex05/fig/sentouki.png"), 0, 0.25)
+        self.img = ASSETS.image("ex05/fig/sentouki.png", 0, 0.25)
         self.dire = (+1, 0)
         self.rect = self.img.get_rect()
         self.rect.center = xy
         self.speed = 10
         self.state="nomal"
         self.hyper_life=-1
+        self.hyper_frames = 0  # これまでに無敵状態だったティック数
+        self.prev = self.rect.topleft  # 前のティックの位置
+        self.flash = False  # このティックに爆発エフェクトを表示するか
 
 
     def change_img(self, screen: pg.Surface):
@@ -61,15 +977,16 @@ class Aircraft(pg.sprite.Sprite):
         戦闘機画像を切り替え，画面に転送する
         引数1 screen：画面Surface
         """
-        self.image = pg.transform.rotozoom(pg.image.load(f"ex05/fig/explosion.gif"), 0, 1.0)
+        self.image = ASSETS.image("ex05/fig/explosion.gif")
         screen.blit(self.image, self.rect)
 
-    def update(self, key_lst: list[bool], screen: pg.Surface):
+    def update(self, key_lst: "Controls"):
         """
         押下キーに応じて戦闘機を移動させる
-        引数1 key_lst：押下キーの真理値リスト
-        引数2 screen：画面Surface
+        引数 key_lst：押下キーの真理値リスト（キーで引けるもの）
         """
+        self.prev = self.rect.topleft
+        self.speed = 20 if key_lst[pg.K_LSHIFT] else 10
         sum_mv = [0, 0]
         for k, mv in __class__.delta.items():
             if key_lst[k]:
@@ -84,12 +1001,31 @@ class Aircraft(pg.sprite.Sprite):
             self.dire = tuple(sum_mv)
             # self.image = self.imgs[self.dire]
         if self.state == "hyper":
-           self.hyper_life -= 1
-           self.img=pg.transform.laplacian(self.img)
+            # 無敵状態の間はラプラシアンフィルタを1ティックに1回重ねてかけた画像にする
+            self.hyper_life -= 1
+            self.hyper_frames += 1
+            frames = ASSETS.strip("ex05/fig/sentouki.png", "laplacian", 501, 0, 0.25)
+            self.img = frames[min(self.hyper_frames, len(frames)-1)]
         if self.hyper_life < 0:
             self.change_state("nomal",-1)
-        screen.blit(self.img, self.rect)
 
+    def draw(self, screen: pg.Surface, alpha: float = 1.0):
+        """
+        戦闘機を前のティックの位置と現在の位置の間に補間して描画する
+        引数1 screen：画面Surface
+        引数2 alpha：前のティックから次のティックまでの経過割合
+        """
+        if self.flash:
+            self.change_img(screen)
+        screen.blit(self.img, lerp(self.prev, self.rect.topleft, alpha))
+
+
+    @property
+    def mask(self) -> pg.mask.Mask:
+        """
+        爆発エフェクトのimageではなく，戦闘機画像のMaskを当たり判定に使う
+        """
+        return ASSETS.mask(self.img)
 
     def get_direction(self) -> tuple[int, int]:
         return self.dire
@@ -100,240 +1036,485 @@ class Aircraft(pg.sprite.Sprite):
         self.hyper_life=hyper_life
 
 
-class Bomb(pg.sprite.Sprite):
+SHOT_KINDS = {
+    # 弾の種類：Projectilesの種類の番号はこの順番
+    # faction：陣営（"enemy"は戦闘機を，"player"は敵を狙う），life：寿命のティック数（負なら画面外まで），
+    # damage：ボスに与えるダメージ，speed：速さ
+    # 円の弾（爆弾）はrads：半径の範囲，colors：色の候補を持ち，発射したものから攻撃対象を狙う
+    # 画像の弾（ビーム）はimage：画像ファイル，scale：拡大率，dir：向きを持つ
+    "bomb": {"faction": "enemy", "life": -1, "damage": 1, "speed": 6, "rads": (10, 50),
+             "colors": [(255, 0, 0), (0, 255, 0), (0, 0, 255), (255, 255, 0), (255, 0, 255), (0, 255, 255)]},
+    # ボスの攻撃
+    "boss_bomb": {"faction": "enemy", "life": -1, "damage": 1, "speed": 4, "rads": (50, 80),
+                  "colors": [(255, 0, 255), (1, 0, 0), (1, 0, 0), (1, 0, 0), (255, 0, 255), (0, 0, 1)]},
+    # ボスの周りを旋回する小さい敵の攻撃
+    "small_bomb": {"faction": "enemy", "life": -1, "damage": 1, "speed": 8, "rads": (10, 30),
+                   "colors": [(255, 255, 0), (0, 255, 255), (0, 0, 255), (255, 0, 0), (255, 255, 255), (200, 70, 120)]},
+    # swept：前のティックの位置から今の位置までを掃引して当たり判定する
+    "beam": {"faction": "player", "life": -1, "damage": 1, "speed": 10, "image": "ex04/fig/beam.png", "scale": 2.0,
+             "dir": (0, -1), "swept": True},
+    # チャージビーム（拡大率はチャージ回数で決まる）
+    "charge_beam": {"faction": "player", "life": -1, "damage": 1, "speed": 10, "image": "ex04/fig/beam.png",
+                    "scale": 3.0, "dir": (0, -1), "swept": True},
+}
+
+
+def spawn_shot(shots: Projectiles, name: str, emitter: pg.sprite.Sprite, target: pg.sprite.Sprite = None,
+               rng: random.Random = random, scale: float = None):
     """
-    爆弾に関するクラス
+    種類nameの弾を1つ生成し，shotsに追加する
+    引数1 shots：弾を追加するProjectiles
+    引数2 name：SHOT_KINDSの弾の種類名
+    引数3 emitter：弾を発射するもの（敵機・ボス・戦闘機）
+    引数4 target：円の弾の攻撃対象
+    引数5 rng：乱数生成器
+    引数6 scale：画像の弾の拡大率（Noneなら種類の拡大率）
     """
-    colors = [(255, 0, 0), (0, 255, 0), (0, 0, 255), (255, 255, 0), (255, 0, 255), (0, 255, 255)]
-    def __init__(self, emy: "Enemy", aircraft: Aircraft):
-        """
-        爆弾円Surfaceを生成する
-        引数1 emy：爆弾を投下する敵機
-        引数2 bird：攻撃対象の戦闘機
-        """
-        super().__init__()
-        rad = random.randint(10, 50) # 爆弾円の半径：10以上50以下の乱数
-        color = random.choice(__class__.colors) # 爆弾円の色：クラス変数からランダム選択
-        self.image = pg.Surface((2*rad, 2*rad))
-        pg.draw.circle(self.image, color, (rad, rad), rad)
-        self.image.set_colorkey((0, 0, 0))
-        self.rect = self.image.get_rect()
-        # 爆弾を投下するemyから見た攻撃対象のaircraftの方向を計算
-        self.vx, self.vy = calc_orientation(emy.rect, aircraft.rect)
-        self.rect.centerx = emy.rect.centerx
-        self.rect.centery = emy.rect.centery+emy.rect.height/2
-        self.speed = 6
+    kind = SHOT_KINDS[name]
+    rad = 0
+    if "rads" in kind:
+        rad = rng.randint(*kind["rads"]) # 爆弾円の半径：範囲の乱数
+        color = rng.choice(kind["colors"]) # 爆弾円の色：候補からランダム選択
+        image = ASSETS.circle(rad, color)
+        rect = image.get_rect()
+        # 爆弾を投下するemitterから見た攻撃対象のtargetの方向を計算
+        vx, vy = calc_orientation(emitter.rect, target.rect)
+        rect.centerx = emitter.rect.centerx
+        rect.centery = emitter.rect.centery+emitter.rect.height/2
+    else:
+        vx, vy = kind["dir"]
+        angle = math.degrees(math.atan2(-vy, vx))
+        image = ASSETS.image(kind["image"], angle, scale or kind["scale"])
+        vx = math.cos(math.radians(angle))
+        vy = -math.sin(math.radians(angle))
+        rect = image.get_rect()
+        rect.centery = emitter.rect.centery+emitter.rect.height*vy
+        rect.centerx = emitter.rect.centerx+emitter.rect.width*vx
+    shots.add(rect, kind["speed"]*vx, kind["speed"]*vy, image, rad, shots.kind_ids[name], kind["life"])
+
+
+TRIG_STEPS = 1024  # 弾幕の角度の分割数（1周をこの数に分ける）
+TRIG_COS = np.cos(np.arange(TRIG_STEPS)*(2*math.pi/TRIG_STEPS))
+TRIG_SIN = np.sin(np.arange(TRIG_STEPS)*(2*math.pi/TRIG_STEPS))
+
+
+def angle_steps(deg: float) -> int:
+    """
+    戻り値：角度deg[度]をTRIG_STEPS分割の番号にしたもの
+    """
+    return round(deg*TRIG_STEPS/360)
 
 
-    def update(self):
+class Pattern:
+    """
+    ボスの弾幕に関するクラス
+    1回の攻撃で出す弾の角度（TRIG_STEPS分割の番号）と速さを配列で作り，
+    sin/cosの表から移動量を求めて，Projectilesにまとめて追加する
+    このクラスは狙った方向に1発だけ撃つ（spawn_shotと同じ）
+    """
+    def __init__(self, count: int = 1, speed: float = None):
         """
-        爆弾を速度ベクトルself.vx, self.vyに基づき移動させる
-        引数 screen：画面Surface
+        引数1 count：1回の攻撃で出す弾の数
+        引数2 speed：弾の速さ（Noneなら弾の種類の速さ）
         """
-        self.rect.move_ip(+self.speed*self.vx, +self.speed*self.vy)
-        if check_bound(self.rect) != (True, True):
-            self.kill()
+        self.count = count
+        self.speed = speed
 
-class BossBomb(pg.sprite.Sprite):
-    colors = [(255, 0, 255), (1, 0, 0), (1, 0, 0), (1, 0, 0), (255, 0, 255), (0, 0, 1)]
-    def __init__(self, emy: "Enemy", aircraft: Aircraft):
+    def angles(self, aim: int) -> np.ndarray:
         """
-        ここではボスの攻撃を作る
-        ボスの爆弾円Surfaceを生成する
-        引数1 emy：爆弾を投下する敵機
-        引数2 bird：攻撃対象のプレイヤー　ここは今後名前を変える。
+        引数 aim：攻撃対象の方向（TRIG_STEPS分割の番号）
+        戻り値：弾ごとの角度の配列
         """
-        super().__init__()
-        rad = random.randint(50, 80)  # 爆弾円の半径：50以上100以下の乱数
-        color = random.choice(__class__.colors)  # 爆弾円の色：クラス変数からランダム選択
-        self.image = pg.Surface((2*rad, 2*rad))
-        pg.draw.circle(self.image, color, (rad, rad), rad)
-        self.image.set_colorkey((0, 0, 0))
-        self.rect = self.image.get_rect()
-        # 爆弾を投下するemyから見た攻撃対象のbirdの方向を計算
-        self.vx, self.vy = calc_orientation(emy.rect, aircraft.rect)
-        self.rect.centerx = emy.rect.centerx
-        self.rect.centery = emy.rect.centery+emy.rect.height/2
-        self.speed = 4
+        return np.full(self.count, aim)
 
-    def update(self):
+    def speeds(self, speed: float) -> np.ndarray:
         """
-        爆弾を速度ベクトルself.vx, self.vyに基づき移動させる
-        引数 screen：画面Surface
+        戻り値：弾ごとの速さの配列
         """
-        self.rect.move_ip(+self.speed*self.vx, +self.speed*self.vy)
-        if check_bound(self.rect) != (True, True):
-            self.kill()
+        return np.full(self.count, speed)
 
-class SmallBossBomb(pg.sprite.Sprite):
-    colors = [(255, 255, 0), (0, 255, 255), (0, 0, 255), (255, 0, 0), (255, 255, 255), (200, 70, 120)]
-    def __init__(self, emy: "Enemy", aircraft: Aircraft):
+    def fire(self, shots: Projectiles, name: str, emitter: pg.sprite.Sprite, target: pg.sprite.Sprite,
+             rng: random.Random = random):
         """
-        ここではボスの周りを旋回する小さい敵の攻撃を作る
-        小さいボスの爆弾円Surfaceを生成する
-        引数1 emy：爆弾を投下する敵機
-        引数2 bird：攻撃対象のプレイヤー　ここは今後名前を変える。
+        弾幕を1回分発射する（色と大きさは1回の攻撃で共通）
+        引数1 shots：弾を追加するProjectiles
+        引数2 name：SHOT_KINDSの円の弾の種類名（色・半径・速さ・寿命に使う）
+        引数3 emitter：発射するボス
+        引数4 target：攻撃対象の戦闘機
+        引数5 rng：乱数生成器
         """
-        super().__init__()
-        small_rad=random.randint(10,30)
-        color=random.choice(__class__.colors)
-        self.image = pg.Surface((2*small_rad, 2*small_rad))
-        pg.draw.circle(self.image, color, (small_rad, small_rad), small_rad)
-        self.image.set_colorkey((0,0,0))
-        self.rect=self.image.get_rect()
-        self.vx, self.vy = calc_orientation(emy.rect, aircraft.rect)
-        self.rect.centerx = emy.rect.centerx
-        self.rect.centery = emy.rect.centery+emy.rect.height/2
-        self.speed = 8
-
-    def update(self):
+        kind = SHOT_KINDS[name]
+        rad = rng.randint(*kind["rads"])
+        image = ASSETS.circle(rad, rng.choice(kind["colors"]))
+        cx = emitter.rect.centerx
+        cy = emitter.rect.centery+emitter.rect.height/2
+        aim = round(math.atan2(target.rect.centery-emitter.rect.centery, target.rect.centerx-emitter.rect.centerx)
+                    * TRIG_STEPS/(2*math.pi))
+        angles = self.angles(aim)%TRIG_STEPS
+        speeds = self.speeds(kind["speed"] if self.speed is None else self.speed)
+        shots.add_many(cx, cy, TRIG_COS[angles]*speeds, TRIG_SIN[angles]*speeds, image, rad,
+                       shots.kind_ids[name], kind["life"])
+
+
+class Radial(Pattern):
+    """
+    全方向に等間隔で撃つ弾幕
+    """
+    def __init__(self, count: int = 24, speed: float = None, offset: float = 0):
         """
-        爆弾を速度ベクトルself.vx, self.vyに基づき移動させる
-        引数 screen：画面Surface
+        引数3 offset：最初の弾の角度[度]
         """
-        self.rect.move_ip(+self.speed*self.vx, +self.speed*self.vy)
-        if check_bound(self.rect) != (True, True):
-            self.kill()
+        super().__init__(count, speed)
+        self.offset = angle_steps(offset)
+
+    def angles(self, aim: int) -> np.ndarray:
+        return self.offset+np.arange(self.count)*TRIG_STEPS//self.count
 
 
-class Beam(pg.sprite.Sprite):
+class Spiral(Radial):
     """
-    ビームに関するクラス
+    撃つたびに角度をturnずつ回す，渦巻きの弾幕
     """
-    def __init__(self, aircraft: Aircraft):
+    def __init__(self, count: int = 4, speed: float = None, turn: float = 12):
         """
-        ビーム画像Surfaceを生成する
-        引数 bird：ビームを放つ戦闘機
+        引数3 turn：1回の攻撃で回す角度[度]
         """
-        super().__init__()
-        self.vx, self.vy = (0,-1) # bird.get_direction()
-        angle = math.degrees(math.atan2(-self.vy, self.vx))
-        self.image = pg.transform.rotozoom(pg.image.load(f"ex04/fig/beam.png"), angle, 2.0) 
-        self.vx = math.cos(math.radians(angle))
-        self.vy = -math.sin(math.radians(angle))
-        self.rect = self.image.get_rect()
-        self.rect.centery = aircraft.rect.centery+aircraft.rect.height*self.vy
-        self.rect.centerx = aircraft.rect.centerx+aircraft.rect.width*self.vx
-        self.speed = 10
+        super().__init__(count, speed)
+        self.turn = angle_steps(turn)
 
-    def update(self):
-        """
-        ビームを速度ベクトルself.vx, self.vyに基づき移動させる
-        引数 screen：画面Surface
-        """
-        self.rect.move_ip(+self.speed*self.vx, +self.speed*self.vy)
-        if check_bound(self.rect) != (True, True):
-            self.kill()
+    def angles(self, aim: int) -> np.ndarray:
+        angles = super().angles(aim)
+        self.offset = (self.offset+self.turn)%TRIG_STEPS
+        return angles
 
 
-class Charge_Beam(pg.sprite.Sprite):
+class Fan(Pattern):
     """
-    チャージビームに関するクラス。
+    攻撃対象の方向を中心に，spreadの範囲に扇形に撃つ弾幕
     """
-    def __init__(self, aircraft: Aircraft, x:int):
+    def __init__(self, count: int = 5, speed: float = None, spread: float = 60):
         """
-        ビーム画像Surfaceを生成する
-        引数 bird：ビームを放つこうかとん
-        引数x：チャージ回数
+        引数3 spread：扇の広さ[度]
         """
-        super().__init__()
-        self.vx, self.vy = (0,-1)
-        angle = math.degrees(math.atan2(-self.vy, self.vx))
-        if 10 <= x <20:
-            self.image = pg.transform.rotozoom(pg.image.load(f"ex04/fig/beam.png"), angle, 3.0)
-        elif 20 <= x:
-            self.image = pg.transform.rotozoom(pg.image.load(f"ex04/fig/beam.png"), angle, 5.0)
-        self.vx = math.cos(math.radians(angle))
-        self.vy = -math.sin(math.radians(angle))
-        self.rect = self.image.get_rect()
-        self.rect.centery = aircraft.rect.centery+aircraft.rect.height*self.vy
-        self.rect.centerx = aircraft.rect.centerx+aircraft.rect.width*self.vx
-        self.speed = 10
+        super().__init__(count, speed)
+        self.spread = angle_steps(spread)
 
+    def angles(self, aim: int) -> np.ndarray:
+        if self.count == 1:
+            return np.full(1, aim)
+        return aim-self.spread//2+np.arange(self.count)*self.spread//(self.count-1)
 
-    def update(self):
+
+class Stream(Pattern):
+    """
+    攻撃対象の方向に，速さを少しずつ変えた弾を一列に撃つ弾幕
+    """
+    def __init__(self, count: int = 6, speed: float = None, step: float = 0.5):
         """
-        ビームを速度ベクトルself.vx, self.vyに基づき移動させる
-        引数 screen：画面Surface
+        引数3 step：隣の弾との速さの差
         """
-        self.rect.move_ip(+self.speed*self.vx, +self.speed*self.vy)
-        if check_bound(self.rect) != (True, True):
-            self.kill()
+        super().__init__(count, speed)
+        self.step = step
+
+    def speeds(self, speed: float) -> np.ndarray:
+        return speed+np.arange(self.count)*self.step
+
+
+PATTERNS = {"aimed": Pattern, "radial": Radial, "spiral": Spiral, "fan": Fan, "stream": Stream}
+
+
+def make_pattern(spec: dict) -> Pattern:
+    """
+    引数 spec：{"type": 弾幕の種類, 他はその弾幕クラスの引数}
+    戻り値：弾幕
+    """
+    params = dict(spec)
+    return PATTERNS[params.pop("type")](**params)
 
 
-class Explosion(pg.sprite.Sprite):
+class Effects:
     """
-    爆発に関するクラス
+    爆発エフェクトをNumPy配列（左上の位置，残り時間，アニメーションするか）でまとめて管理するクラス
+    残り時間を減らす・消すのは配列演算で一度に行い，画像は最初に作っておいたアニメーションの画像から選ぶ
+    数には上限があり，上限を超えたら古いものから消す（どれだけ当たっても描画の量が増えすぎない）
     """
-    def __init__(self, obj: "BossBomb|Bomb|SmallBossBomb|Enemy", life: int): 
+    def __init__(self, frames: list[pg.Surface], budget: int = 256, period: int = 10):
         """
-        爆弾が爆発するエフェクトを生成する
-        引数1 obj：爆発するBombまたは敵機インスタンス
-        引数2 life：爆発時間
+        引数1 frames：アニメーションの画像のリスト（すべて同じ大きさ）
+        引数2 budget：エフェクトの最大数
+        引数3 period：画像を切り替える間隔のティック数
         """
-        super().__init__()
-        img = pg.image.load("ex05/fig/explosion.gif")
-        self.imgs = [img, pg.transform.flip(img, 1, 1)]
-        self.image = self.imgs[0]
-        self.rect = self.image.get_rect(center=obj.rect.center)
-        self.life = life
-
+        self.frames = frames
+        self.budget = budget
+        self.period = period
+        self.size = frames[0].get_size()
+        self.x = np.zeros(budget, np.int32)
+        self.y = np.zeros(budget, np.int32)
+        self.life = np.zeros(budget, np.int32)
+        self.animate = np.zeros(budget, np.bool_)
+        self.n = 0  # 使っている要素数（古い順に並べる）
+        self.evicted = 0  # 上限を超えて消した数
+
+    def __len__(self):
+        return self.n
+
+    def add(self, center: tuple[int, int], life: int, animate: bool = True, limit: int = None):
+        """
+        centerを中心にエフェクトを1つ追加する（数がlimitに達していたら古いものから消す）
+        引数1 center：中心の座標
+        引数2 life：表示するティック数
+        引数3 animate：画像を切り替えるか（Falseなら最初の画像のまま）
+        引数4 limit：この時点の最大数（Noneならbudget，budgetより大きくはできない）
+        """
+        limit = self.budget if limit is None else min(limit, self.budget)
+        if self.n >= limit:
+            drop = self.n-limit+1
+            for arr in (self.x, self.y, self.life, self.animate):
+                arr[:self.n-drop] = arr[drop:self.n]
+            self.n -= drop
+            self.evicted += drop
+        i = self.n
+        w, h = self.size
+        self.x[i], self.y[i] = center[0]-w//2, center[1]-h//2
+        self.life[i] = life
+        self.animate[i] = animate
+        self.n += 1
 
     def update(self):
         """
-        爆発時間を1減算した爆発経過時間_lifeに応じて爆発画像を切り替えることで
-        爆発エフェクトを表現する
+        全てのエフェクトの残り時間を1減らし，尽きたものを消す
+        """
+        n = self.n
+        life = self.life[:n]
+        life -= 1
+        keep = np.flatnonzero(life >= 0)
+        m = len(keep)
+        if m < n:
+            for arr in (self.x, self.y, self.life, self.animate):
+                arr[:m] = arr[keep]
+            self.n = m
+
+    def draw(self, screen: pg.Surface):
         """
-        self.life -= 1
-        self.image = self.imgs[self.life//10%2]
-        if self.life < 0:
-            self.kill()
+        全てのエフェクトを，残り時間で決まるアニメーションの画像で1回のblitsで描画する
+        """
+        n = self.n
+        frame = np.where(self.animate[:n], self.life[:n]//self.period%len(self.frames), 0)
+        frames = self.frames
+        draw_atlas(screen, [(frames[f], (x, y)) for f, x, y in zip(
+            frame.tolist(), self.x[:n].tolist(), self.y[:n].tolist())])
 
 
-class Enemy(pg.sprite.Sprite):
+def draw_atlas(screen: pg.Surface, items: list[tuple[pg.Surface, tuple[float, float]]]):
+    """
+    (画像, 位置)のリストを1回のblitsで描画する（ASSETS.atlasがあればAtlasのページの範囲を描画する）
     """
-    敵機に関するクラス
+    atlas = ASSETS.atlas
+    if atlas is None:
+        screen.blits(items, doreturn=False)
+        return
+    lookup = atlas.lookup
+    screen.blits([(page, pos, area) for (page, area), pos in ((lookup(img), pos) for img, pos in items)],
+                 doreturn=False)
+
+
+ACTOR_KINDS = {
+    # 敵の種類
+    # image：(画像ファイル, 角度, 倍率)，flip：画面の左半分にいるときは左右反転した画像にするか，
+    # pos：出現位置の中心（xがNoneなら乱数，ウェーブ定義の"x"があればそれ），
+    # phase：動かして描画する場面（"wave"は雑魚敵の場面，"boss"はボス戦），
+    # move：動き方（"descend"はstopの範囲の乱数の高さまで降下，"bounce"は出現位置から見たbox
+    # (左, 右, 上, 下)の範囲を往復，Noneは動かない），speed：(横, 縦)の速さ，interval：攻撃間隔の範囲
+    "Enemy": {"image": ("ex05/fig/3.png", 0, 1.0), "flip": True, "pos": (None, 0), "phase": "wave",
+              "move": "descend", "speed": (0, +6), "stop": (50, HEIGHT//2), "interval": (50, 300)},
+    "Boss": {"image": ("ex05/fig/pattie.png", 0, 1.0), "flip": False, "pos": (WIDTH/2, HEIGHT/3), "phase": "boss",
+             "move": None, "speed": (0, 0), "interval": (100, 300)},
+    # ボスの周りを上下左右に揺れる小さなBoss
+    "S_Boss": {"image": ("ex05/fig/kamatou.png", 0, 0.3), "flip": False, "pos": (None, 100), "phase": "boss",
+               "move": "bounce", "speed": (5, 5), "box": (-100, 250, 0, 350), "interval": (20, 100)},
+}
+
+
+class Actor:
     """
-    imgs = pg.image.load(f"ex05/fig/3.png")
-    imgs2 = pg.transform.flip(imgs, True, False) #反転したこうかとん
+    敵機・ボス・小ボスに関するクラス
+    種類ごとの違い（画像・出現位置・動き・攻撃間隔）はACTOR_KINDSのデータで決める
+    """
+    __slots__ = ("kind", "spec", "image", "image2", "rect", "prev", "home", "vx", "vy", "bound", "state",
+                 "interval", "live", "order", "bomb", "on_stop")
 
-    def __init__(self):
-        super().__init__()
-        self.image = self.imgs
-        self.image2 = self.imgs2
+    def __init__(self, kind: str, rng: random.Random = random, x: int = None):
+        """
+        引数1 kind：ACTOR_KINDSの種類名
+        引数2 rng：乱数生成器
+        引数3 x：出現位置のx座標（Noneなら種類の出現位置）
+        """
+        spec = self.spec = ACTOR_KINDS[kind]
+        self.kind = kind
+        self.image = ASSETS.image(*spec["image"])
+        self.image2 = ASSETS.image(*spec["image"], flip=(True, False)) if spec["flip"] else self.image #反転した画像
         self.rect = self.image.get_rect()
-        self.rect.center = random.randint(0, WIDTH), 0
-        self.vy = +6
-        self.bound = random.randint(50, HEIGHT/2) # 停止位置
+        px, py = spec["pos"]
+        if x is not None:
+            px = x
+        elif px is None:
+            px = rng.randint(0, WIDTH)
+        self.rect.center = px, py
+        self.home = self.rect.center  # 出現位置
+        self.vx, self.vy = spec["speed"]
+        self.bound = rng.randint(*spec["stop"]) if spec["move"] == "descend" else None # 停止位置
         self.state = "down" # 降下状態or停止状態
-        self.interval = random.randint(50, 300) # 爆弾投下インターバル
+        self.interval = rng.randint(*spec["interval"]) # 攻撃間隔
+        self.prev = self.rect.topleft  # 前のティックの位置
+        self.live = True
+        self.order = 0  # 出現順
+        self.bomb = None  # 攻撃に使う弾の種類名
+        self.on_stop = None  # 停止状態に入ったときに呼ぶ関数（引数は敵）
+
+    def alive(self) -> bool:
+        return self.live
 
+    def kill(self):
+        self.live = False
 
     def update(self):
         """
-        敵機を速度ベクトルself.vyに基づき移動（降下）させる
-        ランダムに決めた停止位置_boundまで降下したら，_stateを停止状態に変更する
-        引数 screen：画面Surface
+        種類の動き方に従って1ティック分動かす
+        descend：停止位置boundまで降下したら，stateを停止状態に変更し，そのティックだけon_stopを呼ぶ
+        bounce：出現位置から見たboxの範囲を超えたら向きを反転する
+        """
+        self.prev = self.rect.topleft
+        move = self.spec["move"]
+        rect = self.rect
+        if move == "descend":
+            if rect.centery > self.bound:
+                self.vy = 0
+                if self.state == "down" and self.on_stop is not None:
+                    self.on_stop(self)
+                self.state = "stop"
+            rect.centery += self.vy
+        elif move == "bounce":
+            left, right, top, bottom = self.spec["box"]
+            hx, hy = self.home
+            if rect.centery > hy+bottom:
+                self.vy *= -1
+            if rect.centery < hy+top:
+                self.vy *= -1
+            if rect.centerx > hx+right:
+                self.vx *= -1
+            if rect.centerx < hx+left:
+                self.vx *= -1
+            rect.centerx += self.vx
+            rect.centery += self.vy
+        if WIDTH/2 > rect[0]:
+            self.image = self.image2 #画面の左半分だったら画像を反転する
+
+
+class Actors:
+    """
+    すべての敵をまとめて1つのリストで持つクラス
+    動かす・描画するのは1回の走査で，場面（phase）の合う敵だけを対象にする
+    """
+    def __init__(self):
+        self.items = []
+
+    def add(self, actor: Actor):
+        self.items.append(actor)
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    def count(self, kind: str) -> int:
+        """
+        戻り値：種類kindの生きている敵の数
+        """
+        return sum(1 for actor in self.items if actor.live and actor.kind == kind)
+
+    def of(self, kind: str) -> list[Actor]:
+        """
+        戻り値：種類kindの生きている敵のリスト（出現順）
+        """
+        return [actor for actor in self.items if actor.live and actor.kind == kind]
+
+    def view(self, kind: str) -> "ActorView":
+        return ActorView(self, kind)
+
+    def update(self, phase: str):
+        """
+        消えた敵を取り除き，場面phaseの敵を動かす
+        """
+        self.items = [actor for actor in self.items if actor.live]
+        for actor in self.items:
+            if actor.spec["phase"] == phase:
+                actor.update()
+
+    def draw(self, screen: pg.Surface, phase: str, alpha: float):
+        """
+        場面phaseの敵を，前のティックの位置と現在の位置の間に補間して描画する
         """
-        if self.rect.centery > self.bound:
-            self.vy = 0
-            self.state = "stop"
-        self.rect.centery += self.vy
+        draw_atlas(screen, [(actor.image, lerp(actor.prev, actor.rect.topleft, alpha)) for actor in self.items
+                            if actor.live and actor.spec["phase"] == phase])
+
+
+class ActorView:
+    """
+    Actorsのうち1つの種類の敵を，衝突判定で1つのグループとして扱うためのクラス
+    """
+    __slots__ = ("actors", "kind")
+
+    def __init__(self, actors: Actors, kind: str):
+        self.actors = actors
+        self.kind = kind
 
-        if WIDTH/2 > self.rect[0]:
-            self.image = self.image2 #画面の左半分だったらこうかとんの画像を反転する
+    def __iter__(self):
+        return iter(self.actors.of(self.kind))
 
+    def __len__(self):
+        return self.actors.count(self.kind)
 
-class Boss(pg.sprite.Sprite):
+
+class HudText:
     """
-    Bossに関するクラス
+    HUDの文字列画像に関するクラス
+    1文字ずつ描画した画像をキャッシュしておき，文字列が変わったときだけ
+    キャッシュした文字を並べて画像を作り直す
+    文字の位置と画像の幅はfont.sizeで測るので，カーニングを含めてfont.renderと同じ幅になる
     """
-    def __init__(self):
-        super().__init__()
-        self.image = pg.image.load("ex05/fig/pattie.png")
-        self.rect = self.image.get_rect()
-        self.rect.center = (WIDTH/2, HEIGHT/3)
-        self.interval = random.randint(100, 300)
+    def __init__(self, size: int, color: tuple[int, int, int]):
+        """
+        引数1 size：文字サイズ
+        引数2 color：文字色
+        """
+        self.font = ASSETS.font(size)
+        self.size = size
+        self.color = color
+        self.glyphs = {}  # 文字 -> 文字画像Surface
+        self.text = None
+        self.image = None
+        self.renders = 0  # 文字列画像を作り直した回数
+
+    def glyph(self, ch: str) -> pg.Surface:
+        img = self.glyphs.get(ch)
+        if img is None:
+            img = self.glyphs[ch] = self.font.render(ch, 0, self.color)
+        return img
+
+    def render(self, text: str) -> pg.Surface:
+        """
+        引数 text：表示する文字列
+        戻り値：文字列画像Surface（前回と同じ文字列ならキャッシュしたもの）
+        """
+        if text != self.text:
+            size = self.font.size
+            self.image = pg.Surface((size(text)[0], self.font.get_height()), pg.SRCALPHA)
+            for i, ch in enumerate(text):  # 直前の文字とのカーニングを含めるため，その文字までの幅から文字の幅を引く
+                self.image.blit(self.glyph(ch), (size(text[:i+1])[0]-size(ch)[0], 0))
+            self.text = text
+            self.renders += 1
+        return self.image
 
 
 class Boss_HP:
@@ -343,46 +1524,21 @@ class Boss_HP:
     def __init__(self, life):
         self.life=life
         self.now_life=life
-        self.font = pg.font.Font(None, 80)
         self.color = (0, 2, 0)
-        self.img = self.font.render(f"HP: {self.now_life}", 0, self.color)
+        self.text = HudText(80, self.color)
+        self.img = self.text.render(f"HP: {self.now_life}")
         self.rect2 = self.img.get_rect()
         self.rect2.center = 600, 100
 
-    def update(self, screen: pg.Surface):
-        self.img = self.font.render(f"HP: {self.now_life}", 0, self.color)
+    def update(self, screen: pg.Surface, refresh: bool = True):
+        """
+        引数2 refresh：文字列を今のHPで作り直すか（Falseなら前の画像のまま）
+        """
+        if refresh:
+            self.img = self.text.render(f"HP: {self.now_life}")
         screen.blit(self.img, self.rect2)
 
 
-class S_Boss(pg.sprite.Sprite):
-    """
-    小さなBossに関するクラス
-    """
-    def __init__(self, wi):
-        super().__init__()
-        self.wi=wi
-        self.image = pg.transform.rotozoom(pg.image.load("ex05/fig/kamatou.png"), 0, 0.3)
-        self.rect = self.image.get_rect()
-        self.rect.center = (self.wi, 100)
-        self.vx, self.vy = 5, 5
-        self.interval = random.randint(20, 100)
-
-    def update(self):
-        """
-        上下左右に揺れる動きをする
-        """
-        if self.rect.centery > 450:
-            self.vy *= -1
-        if self.rect.centery < 100:
-            self.vy *= -1
-        if self.rect.centerx > self.wi+250:
-            self.vx *= -1
-        if self.rect.centerx < self.wi-100:
-            self.vx *= -1
-        self.rect.centerx += self.vx
-        self.rect.centery += self.vy
-
-
 class Score:
     """
     打ち落とした爆弾，敵機の数をスコアとして表示するクラス
@@ -390,21 +1546,32 @@ class Score:
     敵機：10点
     """
     def __init__(self):
-        self.font = pg.font.Font(None, 50)
         self.color = (0, 0, 255)
         self.score = 0
-        self.image = self.font.render(f"Score: {self.score}", 0, self.color)
+        self.text = HudText(50, self.color)
+        self.image = self.text.render(f"Score: {self.score}")
         self.rect = self.image.get_rect()
         self.rect.center = 100, HEIGHT-50
 
+    def set_size(self, size: int):
+        """
+        スコアの文字サイズを変更する
+        引数 size：文字サイズ
+        """
+        self.text = HudText(size, self.color)
+
     def score_up(self, add):
         self.score += add
 
     def score_down(self,sa):
         self.score -= sa
 
-    def update(self, screen: pg.Surface):
-        self.image = self.font.render(f"Score: {self.score}", 0, self.color)
+    def update(self, screen: pg.Surface, refresh: bool = True):
+        """
+        引数2 refresh：文字列を今のスコアで作り直すか（Falseなら前の画像のまま）
+        """
+        if refresh:
+            self.image = self.text.render(f"Score: {self.score}")
         screen.blit(self.image, self.rect)
 
 class Beam_status:
@@ -412,219 +1579,2284 @@ class Beam_status:
     ビームの状態を表すステータス。ビームのクラスではなく状態を表示させる。
     """
     def __init__(self):
-        self.font = pg.font.Font(None, 50)
+        self.font = ASSETS.font(50)
         self.color = (0, 255, 255)
         self.image = self.font.render(f"normal_beam", 0, self.color)
         self.rect = self.image.get_rect()
         self.rect.center = 300, HEIGHT-50
+        # 表示する文字列は3種類だけなので最初に描画しておく
+        self.imgs = [
+            self.font.render(f"normal BEAM", 0, self.color),
+            self.font.render(f"charge BEAM", 0, (255,255,0)),
+            self.font.render(f"super BEAM", 0, (255,0,0)),
+        ]
 
     def update(self, screen: pg.Surface, x:int):
         """
         x：ビームのチャージ回数。20が一番上それ以上は変わらない
         """
         if x < 10:
-            self.image = self.font.render(f"normal BEAM", 0, self.color)
+            self.image = self.imgs[0]
         elif 10 <= x < 20:
-            self.image = self.font.render(f"charge BEAM", 0, (255,255,0))
+            self.image = self.imgs[1]
         elif 20 <= x:
-            self.image = self.font.render(f"super BEAM", 0, (255,0,0))
+            self.image = self.imgs[2]
         screen.blit(self.image, self.rect)
 
 
-def main():
-    pg.display.set_caption("こうかとんを撃ち落とす")
-    screen = pg.display.set_mode((WIDTH, HEIGHT))
-    bg_img = pg.image.load("ex05/fig/pg_bg.jpg")
-    boss_attack = False
-    score = Score()
-    aircraft = Aircraft((800, 825))
-    beam_status = Beam_status()
-    bombs = pg.sprite.Group()
-    boss_bombs=pg.sprite.Group()
-    small_bombs=pg.sprite.Group()
-    beams = pg.sprite.Group()
-    charge_beam = pg.sprite.Group()
-    exps = pg.sprite.Group()
-    emys = pg.sprite.Group()
-    boss = pg.sprite.Group()
-    s_boss = pg.sprite.Group()
-    boss_hp = Boss_HP(100)
-    tmr = 0
-    x = 0
-    clock = pg.time.Clock()
+class Controls:
+    """
+    1ティック分の入力に関するクラス
+    押し続けて使うキーの集合と，そのティックまでに押されたキーのリストを持つ
+    """
+    keys = (pg.K_LEFT, pg.K_RIGHT, pg.K_LSHIFT)  # 押し続けて使うキー
+    actions = (pg.K_SPACE, pg.K_ESCAPE, pg.K_RSHIFT)  # 押した瞬間に使うキー
 
-    while True:
-        key_lst = pg.key.get_pressed()
+    def __init__(self, held=(), presses=()):
+        """
+        引数1 held：押されているキー
+        引数2 presses：押されたキーのリスト（押された順）
+        """
+        self.held = set(held)
+        self.presses = list(presses)
+
+    def __getitem__(self, key: int) -> bool:
+        """
+        pg.key.get_pressed()と同じく，キーが押されているかを引ける
+        """
+        return key in self.held
+
+
+INPUT_ACTIONS = {pg.K_SPACE: "fire", pg.K_ESCAPE: "charge", pg.K_RSHIFT: "hyper", pg.K_LSHIFT: "dash"}  # キー -> 行動名
+
+
+class InputPipeline:
+    """
+    入力をシミュレーションより前の段で扱うクラス
+    イベントは届いたらすぐ（フレームの間の待ち時間にも）取り出して時刻を付けておき，
+    ティックの始めにControlsにまとめる
+    行動ごとに，キーを押してからティックで処理されるまでと，画面に出るまでの時間を計る
+    """
+    def __init__(self, poll_interval: float = 0.001, window: int = 4096):
+        """
+        引数1 poll_interval：待ち時間の間にイベントを取り出す間隔[秒]
+        引数2 window：行動ごとに残す直近の遅れの数
+        """
+        self.poll_interval = poll_interval
+        self.events = []  # まだ渡していないイベント
+        self.queue = deque()  # まだ処理していない (キー, 押した時刻)
+        self.dash = None  # 押したがまだ処理していないダッシュキーの時刻
+        self.pending = []  # 処理したが画面にまだ出ていない (行動名, 押した時刻, 処理した時刻)
+        # 行動名 -> 直近の(処理までの時間, 表示までの時間) [ms]
+        self.latency = {name: deque(maxlen=window) for name in INPUT_ACTIONS.values()}
+
+    def poll(self):
+        """
+        届いているイベントをすべて取り出し，行動のキーには今の時刻を付けて待ち行列に入れる
+        """
+        now = time.perf_counter()
         for event in pg.event.get():
-            if event.type == pg.QUIT:
-                return 0
-            if event.type == pg.KEYDOWN and event.key == pg.K_SPACE:
-                if x < 10:
-                    beams.add(Beam(aircraft))
-                else:
-                    charge_beam.add(Charge_Beam(aircraft,x))
-                    x = 0
-            if event.type == pg.KEYDOWN and event.key == pg.K_RSHIFT and score.score > 100:
-                score.score_down(100)
-                aircraft.change_state("hyper",500)
-            if event.type == pg.KEYDOWN and event.key == pg.K_ESCAPE:
-                x += 1
-
-
-            if event.type == pg.KEYDOWN and event.key == pg.K_LSHIFT:
-                aircraft.speed = 20
-            if event.type == pg.KEYUP and event.key == pg.K_LSHIFT:
-                aircraft.speed = 10
-        screen.blit(bg_img, [0, 0])
-
-        if not boss_attack:
-            if tmr%200 == 0:  # 200フレームに1回，敵機を出現させる
-                emys.add(Enemy())
-
-            for emy in emys:
-                if emy.state == "stop" and tmr%emy.interval == 0:
-                    # 敵機が停止状態に入ったら，intervalに応じて爆弾投下
-                    bombs.add(Bomb(emy, aircraft))
-
-        if boss_attack:
-            for bos in boss:
-                if tmr%200 == 0:
-                    boss_bombs.add(BossBomb(bos, aircraft))
-
-            for bos in s_boss:
-                if tmr%100 == 0:
-                    small_bombs.add(SmallBossBomb(bos, aircraft))
-
-        for emy in pg.sprite.groupcollide(emys, beams, True, True).keys():
-            exps.add(Explosion(emy, 100))  # 爆発エフェクト
-            score.score_up(10)  # 10点アップ
-
-        # チャージビームの判定
-        for emy in pg.sprite.groupcollide(emys, charge_beam, True, False).keys():
-            exps.add(Explosion(emy, 100))  # 爆発エフェクト
-            score.score_up(10)  # 10点アップ
-            aircraft.change_img(screen)
-
-        for bomb in pg.sprite.groupcollide(boss_bombs, beams, True, True).keys():
-            exps.add(Explosion(bomb, 50))  # 爆発エフェクト
-
-        for bomb in pg.sprite.groupcollide(small_bombs, beams, True, True).keys():
-            exps.add(Explosion(bomb, 50))  # 爆発エフェクト
-
-        for bos in pg.sprite.groupcollide(boss, beams, False, True).keys():
-            exps.add(Explosion(bos, 50))  # 爆発エフェクト
-            boss_hp.now_life -= 1
-
-        for bos in pg.sprite.groupcollide(boss, charge_beam, False, True).keys():
-            exps.add(Explosion(bos, 50))  # 爆発エフェクト
-            boss_hp.now_life -= 1
-
-        for bomb in pg.sprite.groupcollide(bombs, beams, True, True).keys():
-            exps.add(Explosion(bomb, 50))  # 爆発エフェクト
-            score.score_up(1)  # 1点アップ
-
-        # チャージビームの判定
-        for bomb in pg.sprite.groupcollide(bombs, charge_beam, True, False).keys():
-            exps.add(Explosion(bomb, 50))  # 爆発エフェクト
-            score.score_up(1)  # 1点アップ
-
-        for bomb in pg.sprite.groupcollide(boss_bombs, charge_beam, True, False).keys():
-            exps.add(Explosion(bomb, 50))  # 爆発エフェクト
-            score.score_up(1)  # 1点アップ
-
-        for bomb in pg.sprite.groupcollide(small_bombs, charge_beam, True, False).keys():
-            exps.add(Explosion(bomb, 50))  # 爆発エフェクト
-            score.score_up(1)  # 1点アップ
-
-        for bomb in pg.sprite.groupcollide(bombs, beams, True, True).keys():
-            exps.add(Explosion(bomb, 50)) # 爆発エフェクト
-            score.score_up(1) # 1点アップ
-
-        for bomb in pg.sprite.spritecollide(aircraft, bombs, True):
-            if aircraft.state=="hyper":
-                exps.add(Explosion(bomb, 50))
-                score.score_up(1)
-            if aircraft.state=="nomal":
-                aircraft.change_img(screen)
-                score.font = pg.font.Font(None, 250)
-                score.rect.center = WIDTH/2-250, HEIGHT/2 #スコアをやられた際に真ん中に表示
-
-            if aircraft.state=="nomal":
-                aircraft.change_img(screen) # 戦闘機爆発エフェクト
-                score.update(screen)
-                pg.display.update()
-                time.sleep(2)
-                return
+            if event.type == pg.KEYDOWN and event.key in Controls.actions:
+                self.queue.append((event.key, now))
+            elif event.type == pg.KEYDOWN and event.key == pg.K_LSHIFT:
+                self.dash = now
+            self.events.append(event)
+
+    def get(self) -> list[pg.event.Event]:
+        """
+        戻り値：前回から取り出したイベント（QUITなどゲームの外の処理に使う）
+        """
+        self.poll()
+        events, self.events = self.events, []
+        return events
+
+    def take(self) -> Controls:
+        """
+        待ち行列の入力と今押されているキーを1ティック分のControlsにまとめる
+        戻り値：このティックの入力
+        """
+        self.poll()
+        now = time.perf_counter()
+        key_lst = pg.key.get_pressed()
+        held = [k for k in Controls.keys if key_lst[k]]
+        presses = []
+        for key, t in self.queue:
+            presses.append(key)
+            self.pending.append((INPUT_ACTIONS[key], t, now))
+        self.queue.clear()
+        if self.dash is not None and pg.K_LSHIFT in held:
+            self.pending.append(("dash", self.dash, now))
+            self.dash = None
+        return Controls(held, presses)
+
+    def shown(self):
+        """
+        画面を更新した直後に呼び，処理済みの入力の遅れを記録する
+        """
+        now = time.perf_counter()
+        for name, t, sim in self.pending:
+            self.latency[name].append(((sim-t)*1000, (now-t)*1000))
+        self.pending = []
+
+    def wait(self, until: float):
+        """
+        時刻until（perf_counter）まで，イベントを取り出しながら待つ
+        """
+        while (left := until-time.perf_counter()) > 0:
+            self.poll()
+            time.sleep(min(left, self.poll_interval))
+
+    def report(self) -> dict[str, dict[str, float]]:
+        """
+        戻り値：行動名 -> 回数と，処理まで・表示までの時間の50，95パーセンタイルと最大値[ms]
+        """
+        report = {}
+        for name, samples in self.latency.items():
+            if not samples:
+                continue
+            n = len(samples)
+            sim = sorted(s for s, _ in samples)
+            shown = sorted(d for _, d in samples)
+            report[name] = {"count": n, "sim_p50": sim[n//2], "sim_p95": sim[min(n-1, int(n*0.95))],
+                            "p50": shown[n//2], "p95": shown[min(n-1, int(n*0.95))], "max": shown[-1]}
+        return report
+
+
+class DirtyScreen:
+    """
+    画面Surfaceへの描画を中継し，変わった範囲（ダーティ矩形）だけを描き直して画面に反映するクラス
+    1フレーム分の描画を溜めておき，前のフレームから消えた描画，新しく現れた描画，
+    重なり順が変わった描画の範囲だけを背景で消してから，その範囲に重なる描画を順番通りに描き直す
+    変わった範囲が多すぎるときは画面全体を描き直す
+    """
+    def __init__(self, surface: pg.Surface, bg_img: pg.Surface, max_rects: int = 200):
+        """
+        引数1 surface：画面Surface
+        引数2 bg_img：背景画像Surface
+        引数3 max_rects：これより多くの範囲が変わったら画面全体を描き直す
+        """
+        self.surface = surface
+        self.bg_img = bg_img
+        self.max_rects = max_rects
+        self.items = []  # このフレームの描画（画像，位置[，範囲]）
+        self.rects = []  # このフレームの描画の画面上のRect
+        self.prev = {}  # 前のフレームの描画 -> (描画した順番, Rect)
+        self.full = True  # 次のフレームは画面全体を描き直すか
+        self.dirty = 0  # 直前のフレームで描き直した範囲の数（全体なら-1）
+
+    def __getattr__(self, name: str):
+        return getattr(self.surface, name)
+
+    def blit(self, source: pg.Surface, dest, area: pg.Rect = None, special_flags: int = 0) -> pg.Rect:
+        """
+        pg.Surface.blitと同じ引数で描画を溜める
+        戻り値：描画する範囲のRect
+        """
+        pos = int(dest[0]), int(dest[1])
+        if area is None:
+            self.items.append((source, pos))
+            rect = pg.Rect(pos, source.get_size())
+        else:
+            area = pg.Rect(area)
+            self.items.append((source, pos, area))
+            rect = pg.Rect(pos, area.size)
+        self.rects.append(rect)
+        return rect
 
-        if len(pg.sprite.spritecollide(aircraft, bombs, True)) != 0:
-            aircraft.change_img(screen)
+    def blits(self, blit_sequence, doreturn: int = 1):
+        rects = [self.blit(*item) for item in blit_sequence]
+        return rects if doreturn else None
 
+    def set_background(self, bg_img: pg.Surface):
+        """
+        背景を変え，次のフレームで画面全体を描き直す
+        """
+        self.bg_img = bg_img
+        self.full = True
 
-            score.update(screen)
+    def flush(self):
+        """
+        溜めた描画を画面Surfaceに描き，変わった範囲だけを画面に反映する
+        """
+        surface = self.surface
+        cur = {}
+        for item, rect in zip(self.items, self.rects):
+            key = item[0], item[1], None if len(item) == 2 else tuple(item[2]), 0
+            while key in cur:  # 同じ位置に同じ画像を重ねたときは何番目かで区別する
+                key = key[:3]+(key[3]+1,)
+            cur[key] = len(cur), rect
+        dirty = None
+        if not self.full:
+            dirty = [rect for key, (i, rect) in self.prev.items() if key not in cur]
+            last = -1
+            for key, (i, rect) in cur.items():
+                old = self.prev.get(key)
+                if old is None or old[0] < last:  # 新しい描画か，前より下に描かれるようになった描画
+                    dirty.append(rect)
+                else:
+                    last = old[0]
+            dirty = [rect for rect in (r.clip(surface.get_rect()) for r in dirty) if rect]
+            if len(dirty) > self.max_rects:
+                dirty = None
+        if dirty is None:
+            surface.blit(self.bg_img, (0, 0))
+            surface.blits(self.items, doreturn=False)
             pg.display.update()
-            time.sleep(2)
+            self.dirty = -1
+        else:
+            for rect in dirty:
+                surface.set_clip(rect)
+                surface.blit(self.bg_img, rect, rect)
+                surface.blits([self.items[i] for i in rect.collidelistall(self.rects)], doreturn=False)
+            surface.set_clip(None)
+            if dirty:
+                pg.display.update(dirty)
+            self.dirty = len(dirty)
+        self.full = False
+        self.prev = cur
+        self.items = []
+        self.rects = []
+
+
+class Profiler:
+    """
+    ゲームループの処理（フェーズ）ごとの時間をperf_counter_nsで計るクラス
+    直近のフレームの時間の分位点を画面に重ねて表示でき，全フレームの記録をCSV/JSONに書き出せる
+    """
+    def __init__(self, window: int = 250, keep: bool = True):
+        """
+        引数1 window：分位点を求める直近のフレーム数
+        引数2 keep：全フレームの記録を残すか（書き出さないなら残さず，長く動かしてもメモリが増えないようにする）
+        """
+        self.window = window
+        self.keep = keep
+        self.phases = []  # 計ったことのあるフェーズ名（計った順）
+        self.history = {}  # フェーズ名 -> 直近のフレームの時間[ns]のdeque
+        self.trace = []  # フレームごとの記録の辞書のリスト
+        self.frame = {}  # 計測中のフレームのフェーズ名 -> 時間[ns]
+        self.t = 0
+        self.start = 0
+        self.show = False  # 画面に表示するか
+        self.image = None
+        self.frames = 0
+
+    def begin(self):
+        """
+        フレームの計測を始める
+        """
+        self.frame = {}
+        self.start = self.t = time.perf_counter_ns()
+
+    def lap(self, name: str):
+        """
+        前回のlapからの時間をフェーズnameの時間として加える
+        1フレームに同じフェーズを何度計ってもよい（複数ティック進めたときなど）
+        """
+        now = time.perf_counter_ns()
+        self.frame[name] = self.frame.get(name, 0)+now-self.t
+        self.t = now
+
+    def end(self, counts: dict[str, int]):
+        """
+        フレームの計測を終え，記録する
+        引数 counts：グループ名 -> スプライト（弾）の数
+        """
+        frame = self.frame
+        frame["total"] = time.perf_counter_ns()-self.start
+        for name, ns in frame.items():
+            if name not in self.history:
+                self.phases.append(name)
+                self.history[name] = deque(maxlen=self.window)
+            self.history[name].append(ns)
+        if self.keep:
+            self.trace.append({"frame": self.frames, **frame, **counts})
+        self.frames += 1
+
+    def percentiles(self, name: str) -> tuple[float, float, float]:
+        """
+        戻り値：フェーズnameの直近のフレームの時間の50，95，99パーセンタイル[ms]
+        """
+        ns = sorted(self.history[name])
+        n = len(ns)
+        return tuple(ns[min(n-1, int(n*p))]/1e6 for p in (0.5, 0.95, 0.99))
+
+    def draw(self, screen: pg.Surface, counts: dict[str, int]):
+        """
+        各フェーズの時間の分位点とスプライトの数を画面左上に重ねて表示する
+        文字の画像は10フレームに1回だけ作り直す
+        """
+        if not self.show:
             return
+        if self.image is None or self.frames%10 == 0:
+            font = ASSETS.font(24)
+            lines = ["phase      p50    p95    p99 [ms]"]
+            for name in self.phases:
+                lines.append(f"{name:<9}" + "".join(f"{v:7.2f}" for v in self.percentiles(name)))
+            lines.append("  ".join(f"{name}:{n}" for name, n in counts.items()))
+            h = font.get_linesize()
+            self.image = pg.Surface((max(font.size(line)[0] for line in lines)+10, h*len(lines)+10))
+            self.image.set_alpha(200)
+            for i, line in enumerate(lines):
+                self.image.blit(font.render(line, 1, (255, 255, 255)), (5, 5+h*i))
+        screen.blit(self.image, (0, 0))
+
+    def save(self, path: str):
+        """
+        全フレームの記録を書き出す（拡張子が.jsonならJSON，それ以外はCSV）
+        """
+        columns = ["frame", *self.phases]
+        for row in self.trace:
+            columns += [key for key in row if key not in columns]
+        with open(path, "w", newline="") as f:
+            if path.endswith(".json"):
+                json.dump(self.trace, f)
+            else:
+                writer = csv.DictWriter(f, columns, restval=0)
+                writer.writeheader()
+                writer.writerows(self.trace)
+
+
+class MemoryTracker:
+    """
+    長く動かしてもメモリが増え続けないかを調べるクラス
+    一定のティックごとに，tracemallocのスナップショットで確保した場所（ファイル:行）ごとのメモリを，
+    gcでこのファイルのクラス（スプライト・HUD・弾など）ごとの生きているインスタンスの数を記録する
+    後半の記録がすべて前半の記録より多いクラスは，増え続けているとみなす
+    記録そのもの（このクラスの中で確保したメモリ）は数えない
+    """
+    ignore = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, "<frozen *>"),
+              tracemalloc.Filter(False, "<unknown>")]
 
-        if len(pg.sprite.spritecollide(aircraft,boss_bombs,True)) !=0:#ボス用こうかとんの当たり判定
-            aircraft.change_img(screen)
-            score.update(screen)
-            pg.display.update()
-            time.sleep(2)
+    def __init__(self, interval: int = 5000, top: int = 10):
+        """
+        引数1 interval：記録するティック間隔
+        引数2 top：確保した場所を増えた順に何か所表示するか
+        """
+        self.interval = interval
+        self.top = top
+        self.samples = []  # 記録ごとの{"tick", "current", "peak", "growth", "live"}
+        self.first = self.last = None  # 最初と前回のtracemallocのスナップショット
+        self.started = False  # tracemallocをこのMemoryTrackerが始めたか
+        self.classes = [obj for obj in globals().values()
+                        if isinstance(obj, type) and obj.__module__ == __name__]
+        lines, first = inspect.getsourcelines(type(self))
+        self.own = range(first, first+len(lines))  # このクラスの行番号
+
+    def start(self):
+        """
+        tracemallocを始め，最初の記録をとる
+        """
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started = True
+        self.sample(0)
+
+    def stop(self):
+        """
+        startでtracemallocを始めていたら止める（ほかで始めていたものは止めない）
+        """
+        if self.started:
+            tracemalloc.stop()
+            self.started = False
+        self.first = self.last = None
+
+    def live_counts(self) -> dict[str, int]:
+        """
+        戻り値：クラス名 -> 生きているインスタンスの数（循環参照で残っているだけのものは先に回収する）
+        """
+        gc.collect()
+        counts = dict.fromkeys((cls.__name__ for cls in self.classes), 0)
+        classes = set(self.classes)
+        for obj in gc.get_objects():
+            cls = type(obj)
+            if cls in classes:
+                counts[cls.__name__] += 1
+        return counts
+
+    def sample(self, tick: int) -> dict:
+        """
+        今のメモリの使用量と，前回から増えた場所と，クラスごとのインスタンスの数を記録する
+        戻り値：記録した辞書
+        """
+        live = self.live_counts()
+        snap = tracemalloc.take_snapshot().filter_traces(self.ignore)
+        growth = self.growth(snap, self.last) if self.last is not None else []
+        if self.first is None:
+            self.first = snap
+        self.last = snap
+        current = sum(stat.size for stat in snap.statistics("lineno") if not self.is_own(stat.traceback[0]))
+        sample = {"tick": tick, "current": current, "peak": tracemalloc.get_traced_memory()[1], "growth": growth,
+                  "live": live}
+        self.samples.append(sample)
+        return sample
+
+    def is_own(self, frame: tracemalloc.Frame) -> bool:
+        """
+        戻り値：frameがこのクラスの中（記録のためのメモリ）か
+        """
+        return frame.lineno in self.own and frame.filename == __file__
+
+    def growth(self, snap: tracemalloc.Snapshot, base: tracemalloc.Snapshot) -> list[tuple[str, int, int]]:
+        """
+        戻り値：baseからsnapまでに増えた場所（ファイル:行），増えたバイト数，増えた確保の数のリスト（多い順にtop個）
+        """
+        stats = [stat for stat in snap.compare_to(base, "lineno")
+                 if stat.size_diff > 0 and not self.is_own(stat.traceback[0])]
+        return [(str(stat.traceback[0]), stat.size_diff, stat.count_diff) for stat in stats[:self.top]]
+
+    def rising(self) -> list[str]:
+        """
+        戻り値：後半の記録の数がすべて前半の記録の数より多いクラス名（"traced"は使用量全体）のリスト
+        最初の記録（起動直後）は除き，記録が4回以上あるときだけ調べる
+        """
+        samples = self.samples[1:]
+        if len(samples) < 4:
+            return []
+        half = len(samples)//2
+        series = {"traced": [s["current"] for s in samples]}
+        for name in samples[0]["live"]:
+            series[name] = [s["live"][name] for s in samples]
+        return [name for name, values in series.items() if min(values[half:]) > max(values[:half])]
+
+    def report(self) -> dict:
+        """
+        戻り値：記録のリスト，最初の記録から増えた場所，増え続けているクラスの辞書
+        """
+        growth = self.growth(self.last, self.first) if self.first is not None else []
+        return {"samples": self.samples, "growth": growth, "rising": self.rising()}
+
+    @staticmethod
+    def print_sample(sample: dict):
+        print(f"memory @{sample['tick']}: {sample['current']/1024:.0f}KB (peak {sample['peak']/1024:.0f}KB)")
+        for site, size, count in sample["growth"]:
+            print(f"  +{size/1024:8.1f}KB {count:+6d}  {site}")
+
+    @staticmethod
+    def print_report(report: dict):
+        """
+        記録の一覧と，最初の記録から増えた場所，増え続けているクラスを表示する
+        """
+        samples = report["samples"]
+        names = [name for name in samples[0]["live"] if any(s["live"][name] for s in samples)]
+        print(f"{'tick':>8}{'traced[KB]':>12}  " + "".join(f"{name[:11]:>12}" for name in names))
+        for s in samples:
+            print(f"{s['tick']:8}{s['current']/1024:12.0f}  " + "".join(f"{s['live'][name]:12}" for name in names))
+        print("growth since start:")
+        for site, size, count in report["growth"]:
+            print(f"  +{size/1024:8.1f}KB {count:+6d}  {site}")
+        print("rising: " + (", ".join(report["rising"]) or "none"))
+
+    @staticmethod
+    def save(report: dict, path: str):
+        with open(path, "w") as f:
+            json.dump(report, f, indent=1)
+
+
+QUALITY_LEVELS = [
+    # max_exps：爆発の最大数（超えたら古いものから消す），exp_life：爆発時間の倍率，exp_anim：爆発画像を切り替えるか，
+    # background：背景画像を描くか（Falseなら単色），hud_every：HUDの文字を作り直すフレーム間隔
+    {"max_exps": None, "exp_life": 1.0, "exp_anim": True, "background": True, "hud_every": 1},
+    {"max_exps": 64, "exp_life": 0.5, "exp_anim": True, "background": True, "hud_every": 1},
+    {"max_exps": 32, "exp_life": 0.5, "exp_anim": False, "background": True, "hud_every": 1},
+    {"max_exps": 32, "exp_life": 0.5, "exp_anim": False, "background": False, "hud_every": 1},
+    {"max_exps": 16, "exp_life": 0.25, "exp_anim": False, "background": False, "hud_every": 10},
+]
+
+
+class Governor:
+    """
+    フレームの処理時間を見て，予算を超えたら描画の品質を1段階ずつ落とし，
+    余裕ができたら1段階ずつ戻すクラス
+    品質は見た目だけに関わるので，ゲームの進み方（リプレイ）は変わらない
+    """
+    def __init__(self, budget: float, levels: list[dict] = QUALITY_LEVELS, window: int = 30, hold: int = 120):
+        """
+        引数1 budget：1フレームの処理時間の予算[ms]
+        引数2 levels：品質の段階（先頭が最高品質）
+        引数3 window：平均をとる直近のフレーム数
+        引数4 hold：品質を戻すまでに，予算の6割未満が続かなければならないフレーム数
+        """
+        self.budget = budget
+        self.levels = levels
+        self.hold = hold
+        self.level = 0
+        self.recent = deque(maxlen=window)
+        self.calm = 0  # 予算の6割未満が続いたフレーム数
+        self.frames = 0
+        self.log = []  # 品質を変えた記録
+
+    @property
+    def quality(self) -> dict:
+        return self.levels[self.level]
+
+    def update(self, ms: float) -> bool:
+        """
+        1フレームの処理時間を加え，必要なら品質を変える
+        引数 ms：フレームの処理時間[ms]
+        戻り値：品質を変えたか
+        """
+        self.frames += 1
+        self.recent.append(ms)
+        if len(self.recent) < self.recent.maxlen:
+            return False
+        mean = sum(self.recent)/len(self.recent)
+        if mean > self.budget:
+            self.calm = 0
+            if self.level < len(self.levels)-1:
+                return self.change(self.level+1, mean)
+        elif mean < self.budget*0.6:
+            self.calm += 1
+            if self.calm >= self.hold and self.level > 0:
+                return self.change(self.level-1, mean)
+        else:
+            self.calm = 0
+        return False
+
+    def change(self, level: int, mean: float) -> bool:
+        """
+        品質をlevelに変え，記録して表示する
+        変えた直後の処理時間で判断しないよう，平均をとり直す
+        """
+        self.log.append({"frame": self.frames, "from": self.level, "to": level, "ms": round(mean, 2)})
+        print(f"quality: {self.level} -> {level}  (frame {self.frames}, {mean:.1f}ms / {self.budget:.1f}ms)")
+        self.level = level
+        self.recent.clear()
+        self.calm = 0
+        return True
+
+
+class Scheduler:
+    """
+    先のティックに行う処理（出現・攻撃）を優先度付きキューで管理するクラス
+    毎ティック全員の間隔を調べる代わりに，次に処理するティックを登録しておき，
+    そのティックが来たものだけを取り出す
+    """
+    def __init__(self):
+        self.queue = []  # (ティック, 優先度, 登録順, 関数, 引数) のヒープ
+        self.seq = 0
+        self.fired = 0  # 実行した処理の数
+
+    def at(self, tick: int, func, *args, priority: int = 0):
+        """
+        引数1 tick：処理を行うティック
+        引数2 func：呼び出す関数
+        引数3 args：funcに渡す引数
+        引数4 priority：同じティックの処理の順番（小さい方が先）
+        """
+        heapq.heappush(self.queue, (tick, priority, self.seq, func, args))
+        self.seq += 1
+
+    def run(self, tick: int):
+        """
+        tickまでに予定された処理を順番に行う
+        """
+        queue = self.queue
+        while queue and queue[0][0] <= tick:
+            _, _, _, func, args = heapq.heappop(queue)
+            func(*args)
+            self.fired += 1
+
+    def __len__(self) -> int:
+        return len(self.queue)
+
+
+WAVES_FILE = "ex05/waves.json"  # ウェーブ定義ファイル
+DEFAULT_WAVES = {
+    # 雑魚敵の出現（countが0なら，ボス戦が始まるまで出し続ける）
+    "enemies": [
+        {"type": "Enemy", "start": 0, "every": 200, "count": 0, "bomb": "bomb"},
+    ],
+    # scoreを超えたらボス戦に入り，attackersを出現させてevery ティックごとに攻撃させる
+    # typeはACTOR_KINDS，bombはSHOT_KINDSの種類名，xは出現位置のx座標（省略すると種類の出現位置）
+    # attackersに"pattern": {"type": "radial", "count": 24}のように書くと，その弾幕で攻撃する
+    "boss": {
+        "score": 20,
+        "hp": 100,
+        "attackers": [
+            {"type": "Boss", "every": 200, "bomb": "boss_bomb"},
+            {"type": "S_Boss", "x": 200, "every": 100, "bomb": "small_bomb"},
+            {"type": "S_Boss", "x": 1200, "every": 100, "bomb": "small_bomb"},
+        ],
+    },
+}
+
+
+def load_waves(path: str = WAVES_FILE) -> dict:
+    """
+    ウェーブ定義ファイル（JSON）を読み込む
+    引数 path：ファイルのパス（ファイルがなければ既定のウェーブ）
+    戻り値：ウェーブ定義の辞書
+    """
+    if not os.path.exists(path):
+        return DEFAULT_WAVES
+    with open(path) as f:
+        waves = json.load(f)
+    for spec in waves["enemies"]+waves["boss"]["attackers"]:
+        if spec["type"] not in ACTOR_KINDS:
+            raise ValueError(f"{path}: unknown type {spec['type']!r}")
+        if spec["bomb"] not in SHOT_KINDS:
+            raise ValueError(f"{path}: unknown bomb {spec['bomb']!r}")
+        if "pattern" in spec and spec["pattern"]["type"] not in PATTERNS:
+            raise ValueError(f"{path}: unknown pattern {spec['pattern']['type']!r}")
+    return waves
+
+
+ASSET_MANIFEST = {  # 起動時にAssets.preloadで作っておく画像
+    "folder": "ex05/fig",  # このフォルダのファイルはすべて読み込む
+    "files": ["ex04/fig/beam.png"],  # フォルダの外で使うファイル
+    "fonts": [24, 50, 80, 250],
+    # (パス, 角度, 倍率, 反転)：ゲーム中にASSETS.imageで使う組み合わせ
+    "images": [
+        ("ex05/fig/pg_bg.jpg", 0, 1.0, (False, False)),
+        ("ex05/fig/sentouki.png", 0, 0.25, (False, False)),
+        ("ex05/fig/explosion.gif", 0, 1.0, (False, False)),
+        ("ex05/fig/3.png", 0, 1.0, (False, False)),
+        ("ex05/fig/3.png", 0, 1.0, (True, False)),
+        ("ex05/fig/pattie.png", 0, 1.0, (False, False)),
+        ("ex05/fig/kamatou.png", 0, 0.3, (False, False)),
+        *[("ex04/fig/beam.png", 90.0, scale, (False, False)) for scale in (2.0, 3.0, 5.0)],
+    ],
+    # (パス, 効果, 最大枚数, 角度, 倍率)：ASSETS.stripで使う組み合わせ
+    "strips": [
+        ("ex05/fig/sentouki.png", "laplacian", 501, 0, 0.25),
+        ("ex05/fig/explosion.gif", "flip", 2, 0, 1.0),
+    ],
+    # (半径, 色)：爆弾の円
+    "circles": [(rad, color) for kind in SHOT_KINDS.values() if "rads" in kind
+                for rad in range(kind["rads"][0], kind["rads"][1]+1) for color in kind["colors"]],
+    "masks": True,  # 作った画像のMaskも作っておく（当たり判定用）
+    # Atlasに詰める画像：敵・ボスの画像と向き，ビームの大きさ，爆発のアニメーション（と爆弾の円）
+    "atlas": {
+        "width": 192,
+        "images": [
+            ("ex05/fig/3.png", 0, 1.0, (False, False)),
+            ("ex05/fig/3.png", 0, 1.0, (True, False)),
+            ("ex05/fig/pattie.png", 0, 1.0, (False, False)),
+            ("ex05/fig/kamatou.png", 0, 0.3, (False, False)),
+            *[("ex04/fig/beam.png", 90.0, scale, (False, False)) for scale in (2.0, 3.0, 5.0)],
+        ],
+        "strips": [("ex05/fig/explosion.gif", "flip", 2, 0, 1.0)],
+    },
+}
+
+
+HIT_RULES = [
+    # (a, b, aを消すか, bを消すか, 処理)：種類aと種類bが当たったら，Gameの処理メソッドを呼ぶ
+    # 種類はACTOR_KINDS・SHOT_KINDSの種類名または"aircraft"（戦闘機），上から順に判定する
+    ("Enemy", "beam", True, True, "shoot_emy"),
+    ("Enemy", "charge_beam", True, False, "pierce_emy"),  # チャージビームは貫通する
+    ("boss_bomb", "beam", True, True, "shoot_boss_bomb"),
+    ("small_bomb", "beam", True, True, "shoot_boss_bomb"),
+    ("Boss", "beam", False, True, "shoot_boss"),
+    ("Boss", "charge_beam", False, False, "shoot_boss"),  # 貫通しても，1本で当たるのは1回だけ
+    ("bomb", "beam", True, True, "shoot_bomb"),
+    ("bomb", "charge_beam", True, False, "shoot_bomb"),
+    ("boss_bomb", "charge_beam", True, False, "shoot_bomb"),
+    ("small_bomb", "charge_beam", True, False, "shoot_bomb"),
+    ("bomb", "aircraft", True, False, "hit_bomb"),
+    ("boss_bomb", "aircraft", True, False, "hit_boss_bomb"),  # ボス用こうかとんの当たり判定
+    ("small_bomb", "aircraft", True, False, "hit_boss_bomb"),  # 小ボス用こうかとんの当たり判定
+]
+
+
+SNAPSHOT_HEADER = struct.Struct(
+    "<4sHIQ"  # 識別子，版，ウェーブ定義のCRC32，乱数の種
+    "IiIiHhhiiBBBQQ"  # ティック，チャージ回数，出現数，スコア，文字サイズ，表示位置，ボスのHP，残りHP，ボス戦か，無敵か，結果，予定の登録順・実行数
+    "iiiiiibbhBiiB"  # 戦闘機のRect，前の位置，向き，速さ，無敵か，無敵の残り，無敵だったティック数，爆発を表示するか
+    "IQIIIII"  # 弾の数，次の通し番号，敵の数，予定の数，貫通の記録の数，爆発の数，JSONの長さ
+    "?d"  # 乱数のgaussの続きがあるか，その値
+)
+SNAPSHOT_SHOT = [("x", np.int32), ("y", np.int32), ("w", np.int32), ("h", np.int32), ("dx", np.int32),
+                 ("dy", np.int32), ("rad", np.int32), ("img", np.int32), ("kind", np.int8), ("life", np.int32),
+                 ("uid", np.int64), ("live", np.bool_), ("moved", np.bool_)]  # Projectilesの列
+SNAPSHOT_ACTOR = np.dtype([
+    ("kind", np.int8), ("rect", np.int32, 4), ("prev", np.int32, 2), ("home", np.int32, 2), ("v", np.int32, 2),
+    ("bound", np.int32), ("has_bound", np.bool_), ("stopped", np.bool_), ("interval", np.int32),
+    ("live", np.bool_), ("order", np.int32), ("bomb", np.int8), ("on_stop", np.bool_), ("flipped", np.bool_)])
+SNAPSHOT_EVENT = np.dtype([  # Schedulerの予定（関数はSNAPSHOT_FUNCSの番号，引数は番号に直したもの）
+    ("tick", np.int64), ("priority", np.int64), ("seq", np.int64), ("func", np.int8), ("args", np.int64, 4)])
+SNAPSHOT_FUNCS = ["spawn_enemy", "attack"]
+SNAPSHOT_EFFECT = [("x", np.int32), ("y", np.int32), ("life", np.int32), ("animate", np.bool_)]  # Effectsの列
+SNAPSHOT_RESULTS = [None, "dead", "clear"]
+
+
+class Game:
+    """
+    ゲームの状態と，1ティック分の処理に関するクラス
+    描画とは切り離してあり，stepを呼んだ回数だけゲームが進む
+    乱数はゲームごとの乱数生成器から引くので，種と入力が同じなら同じように進む
+    """
+    def __init__(self, seed: int = None, waves: dict = None):
+        """
+        引数1 seed：乱数の種（Noneなら適当に決める）
+        引数2 waves：ウェーブ定義（Noneなら既定のウェーブ）
+        """
+        self.seed = random.randrange(2**32) if seed is None else seed
+        self.waves = DEFAULT_WAVES if waves is None else waves
+        self.rng = random.Random(self.seed)
+        self.boss_attack = False
+        self.score = Score()
+        self.aircraft = Aircraft((800, 825))
+        self.beam_status = Beam_status()
+        swept = [name for name, kind in SHOT_KINDS.items() if kind.get("swept")]
+        self.shots = Projectiles(256, SHOT_KINDS, swept)  # 爆弾・ビーム
+        self.actors = Actors()  # 敵機・ボス・小ボス
+        self.exps = Effects(ASSETS.strip("ex05/fig/explosion.gif", "flip", 2))  # 爆発
+        self.boss_hp = Boss_HP(self.waves["boss"]["hp"])
+        self.tmr = 0
+        self.scheduler = Scheduler()
+        self.spawned = 0  # 出現させた敵の数（同じティックの攻撃は出現順に行う）
+        for wave in self.waves["enemies"]:
+            self.scheduler.at(wave["start"], self.spawn_enemy, wave, wave["count"])
+        self.x = 0  # チャージ回数
+        self.result = None  # ゲームが終わったら"dead"（やられた）または"clear"（ボスを倒した）
+        self.prof = None  # 処理時間を計るProfiler
+        self.invincible = False  # 爆弾に当たってもゲームを終わらせない（ベンチマーク用）
+        self.boss_score = self.waves["boss"]["score"]  # このスコアを超えたらボス戦（ベンチマークでは場面を保つために変える）
+        self.quality = QUALITY_LEVELS[0]  # 描画の品質（Governorが変える）
+        self.frames = 0  # 描画した回数
+        self.waves_crc = zlib.crc32(json.dumps(self.waves, sort_keys=True).encode())
+
+        self.collisions = Collisions(precise=True)
+        for name in SHOT_KINDS:
+            self.collisions.add_group(name, self.shots.view(name))
+        for name in ACTOR_KINDS:
+            self.collisions.add_group(name, self.actors.view(name))
+        self.collisions.add_group("aircraft", pg.sprite.GroupSingle(self.aircraft))
+        for a, b, kill_a, kill_b, handler in HIT_RULES:
+            self.collisions.add_pair(a, b, kill_a, kill_b, getattr(self, handler))
+
+    def explode(self, obj: "Projectile|Actor", life: int):
+        """
+        objの位置に爆発エフェクトを出す（数・時間・アニメーションは描画の品質に従う）
+        """
+        quality = self.quality
+        self.exps.add(obj.rect.center, max(1, int(life*quality["exp_life"])), quality["exp_anim"],
+                      quality["max_exps"])
+
+    def shoot_emy(self, emy, hits):
+        self.explode(emy, 100)  # 爆発エフェクト
+        self.score.score_up(10)  # 10点アップ
+
+    def pierce_emy(self, emy, hits):
+        self.shoot_emy(emy, hits)
+        self.aircraft.flash = True
+
+    def shoot_bomb(self, bomb, hits):
+        self.explode(bomb, 50)  # 爆発エフェクト
+        self.score.score_up(1)  # 1点アップ
+
+    def shoot_boss_bomb(self, bomb, hits):
+        self.explode(bomb, 50)  # 爆発エフェクト
+
+    def shoot_boss(self, bos, hits):
+        self.explode(bos, 50)  # 爆発エフェクト
+        self.boss_hp.now_life -= SHOT_KINDS[hits[0].kind]["damage"]
+
+    def hit_bomb(self, bomb, hits):
+        if self.aircraft.state=="hyper" or self.invincible:
+            self.shoot_bomb(bomb, hits)
+        elif self.aircraft.state=="nomal":
+            self.score.set_size(250)
+            self.score.rect.center = WIDTH/2-250, HEIGHT/2 #スコアをやられた際に真ん中に表示
+            self.result = "dead"
+
+    def hit_boss_bomb(self, bomb, hits):
+        if self.invincible:
+            self.shoot_boss_bomb(bomb, hits)
+        else:
+            self.result = "dead"
+
+    def press(self, key: int):
+        """
+        押されたキーに応じてビームの発射，チャージ，無敵化を行う
+        引数 key：押されたキー
+        """
+        aircraft = self.aircraft
+        if key == pg.K_SPACE:
+            if self.x < 10:
+                spawn_shot(self.shots, "beam", aircraft)
+            else:
+                # 10回以上ならチャージビーム，20回以上ならスーパービーム（大きさが違う）
+                spawn_shot(self.shots, "charge_beam", aircraft, scale=3.0 if self.x < 20 else 5.0)
+                self.x = 0
+        if key == pg.K_RSHIFT and self.score.score > 100:
+            self.score.score_down(100)
+            aircraft.change_state("hyper",500)
+        if key == pg.K_ESCAPE:
+            self.x += 1
+
+    def step(self, controls: Controls):
+        """
+        ゲームを1ティック進める
+        引数 controls：このティックの入力
+        """
+        aircraft = self.aircraft
+        prof = self.prof
+        aircraft.flash = False  # 衝突判定で立ったら，このティックの描画まで残す
+        for key in controls.presses:
+            self.press(key)
+        if prof:
+            prof.lap("input")
+
+        self.scheduler.run(self.tmr)  # このティックの出現・攻撃
+        if prof:
+            prof.lap("spawn")
+
+        self.collisions.run()
+        if prof:
+            prof.lap("collision")
+        if self.result is not None:
             return
 
-        if len(pg.sprite.spritecollide(aircraft,small_bombs,True)) !=0:#小ボス用こうかとんの当たり判定
-            aircraft.change_img(screen)
-            score.update(screen)
-            pg.display.update()
-            time.sleep(2)
+        self.actors.update(self.phase)
+        aircraft.update(controls)
+        self.shots.update()
+        self.exps.update()
+        if self.score.score > self.boss_score and self.boss_attack==False:
+            self.start_boss()
+        if self.boss_hp.now_life<1:
+            self.result = "clear"
+        self.tmr += 1
+        if prof:
+            prof.lap("update")
+
+    def next_tick(self, every: int) -> int:
+        """
+        戻り値：今のティックより後で，everyの倍数になる最初のティック
+        """
+        return (self.tmr//every+1)*every
+
+    def spawn_enemy(self, wave: dict, left: int):
+        """
+        ウェーブの敵機を1体出現させ，次の出現を予定する
+        引数1 wave：ウェーブ定義
+        引数2 left：残りの出現数（0なら無制限）
+        """
+        if self.boss_attack:
             return
+        self.add_enemy(Actor(wave["type"], self.rng), wave["bomb"])
+        if left != 1:
+            self.scheduler.at(self.tmr+wave["every"], self.spawn_enemy, wave, max(left-1, 0))
 
-        if len(pg.sprite.spritecollide(aircraft, bombs, True)) != 0:
-            aircraft.change_img(screen) # 戦闘機爆発エフェクト
-            score.update(screen)
-            pg.display.update()
-            time.sleep(2)
+    def add_enemy(self, emy: Actor, bomb: str = "bomb"):
+        """
+        敵機を追加する（停止状態に入ったら，intervalに応じて爆弾を投下し始める）
+        引数1 emy：敵機
+        引数2 bomb：投下する弾の種類名
+        """
+        self.spawned += 1
+        emy.order = self.spawned
+        emy.bomb = bomb
+        emy.on_stop = self.enemy_stopped
+        self.actors.add(emy)
+
+    def enemy_stopped(self, emy: Actor):
+        self.scheduler.at(self.next_tick(emy.interval), self.attack, emy, emy.bomb, emy.interval,
+                          priority=emy.order)
+
+    def attack(self, emy: Actor, bomb: str, every: int, pattern: Pattern = None):
+        """
+        emyに爆弾を投下させ，everyティック後の攻撃を予定する
+        雑魚敵はボス戦が始まったら攻撃をやめる
+        引数4 pattern：弾幕（Noneなら狙った方向に1発）
+        """
+        if not emy.alive() or emy.spec["phase"] != self.phase:
             return
+        if pattern is None:
+            spawn_shot(self.shots, bomb, emy, self.aircraft, self.rng)
+        else:
+            pattern.fire(self.shots, bomb, emy, self.aircraft, self.rng)
+        self.scheduler.at(self.tmr+every, self.attack, emy, bomb, every, pattern, priority=emy.order)
 
-        if boss_attack:
-            boss.draw(screen)
-            boss_hp.update(screen)
-            s_boss.update()
-            s_boss.draw(screen)
-            small_bombs.update()
-            boss_bombs.update()
-            small_bombs.draw(screen)
-            boss_bombs.draw(screen)
+    def start_boss(self):
+        """
+        ウェーブ定義のボスを出現させ，ボス戦を始める
+        """
+        self.boss_attack = True
+        for spec in self.waves["boss"]["attackers"]:
+            bos = Actor(spec["type"], self.rng, spec.get("x"))
+            self.spawned += 1
+            bos.order = self.spawned
+            self.actors.add(bos)
+            pattern = make_pattern(spec["pattern"]) if "pattern" in spec else None
+            self.scheduler.at(self.next_tick(spec["every"]), self.attack, bos, spec["bomb"],
+                              spec["every"], pattern, priority=bos.order)
+
+    @property
+    def phase(self) -> str:
+        """
+        戻り値：今の場面（"wave"は雑魚敵の場面，"boss"はボス戦）
+        """
+        return "boss" if self.boss_attack else "wave"
+
+    def counts(self) -> dict[str, int]:
+        """
+        戻り値：種類名 -> 弾・敵・爆発の数 の辞書
+        """
+        return {**dict(zip(self.shots.kinds, self.shots.counts)),
+                **{name: self.actors.count(name) for name in ACTOR_KINDS}, "exps": len(self.exps)}
+
+    def checksum(self) -> int:
+        """
+        戻り値：ゲームの状態から計算したCRC32（再生が記録と一致するかの確認に使う）
+        """
+        crc = zlib.crc32(struct.pack("<6i", self.tmr, self.score.score, self.x, self.boss_hp.now_life,
+                                     *self.aircraft.rect.topleft))
+        for name in ACTOR_KINDS:
+            for actor in self.actors.of(name):
+                crc = zlib.crc32(struct.pack("<2i", *actor.rect.topleft), crc)
+        shots = self.shots
+        kind = shots.kind[:shots.n]
+        for k in range(len(shots.kinds)):
+            sel = kind == k
+            for arr in (shots.x, shots.y, shots.rad, shots.live):
+                crc = zlib.crc32(arr[:shots.n][sel].tobytes(), crc)
+        return crc
+
+    def snapshot(self) -> bytes:
+        """
+        シミュレーションの状態（乱数の状態を含む）をバイト列にまとめる
+        数値はstructとNumPy配列のまま詰め，画像は作り方のキー，予定の関数と引数は番号にする
+        描画の品質や処理時間の計測など，ゲームの進み方に関わらないものは含めない
+        戻り値：restoreに渡せるバイト列
+        """
+        shots, actors, exps = self.shots, self.actors.items, self.exps
+        aircraft, score = self.aircraft, self.score
+        kind_ids = shots.kind_ids
+        actor_ids = {id(actor): i for i, actor in enumerate(actors)}
+        waves = self.waves["enemies"]
+        # 予定（死んだ敵の攻撃は何もしないので捨てる）
+        patterns = []
+        pattern_ids = {}
+        events = []
+        for tick, priority, seq, func, args in self.scheduler.queue:
+            if func.__name__ == "spawn_enemy":
+                wave, left = args
+                events.append((tick, priority, seq, 0, (waves.index(wave), left, 0, 0)))
+                continue
+            emy, bomb, every, *pattern = args
+            if id(emy) not in actor_ids:
+                continue
+            pattern = pattern[0] if pattern else None
+            p = -1
+            if pattern is not None:
+                if id(pattern) not in pattern_ids:
+                    pattern_ids[id(pattern)] = len(patterns)
+                    name = next(name for name, cls in PATTERNS.items() if cls is type(pattern))
+                    patterns.append({"type": name, **vars(pattern)})
+                p = pattern_ids[id(pattern)]
+            events.append((tick, priority, seq, 1, (actor_ids[id(emy)], kind_ids[bomb], every, p)))
+        events = np.array(events, SNAPSHOT_EVENT)
+        # 貫通の記録（弾は通し番号，敵は-2-番号，戦闘機は-1）
+        def key(obj):
+            if isinstance(obj, int):
+                return obj
+            if obj is aircraft:
+                return -1
+            return -2-actor_ids[id(obj)] if id(obj) in actor_ids else None
+        pierced = [(key(k), key(hit)) for k, hits in self.collisions.pierced.items() for hit in hits]
+        pierced = np.array(sorted(pair for pair in pierced if None not in pair), np.int64).reshape(-1, 2)
+        rows = np.zeros(len(actors), SNAPSHOT_ACTOR)
+        for row, actor in zip(rows, actors):
+            row["kind"] = list(ACTOR_KINDS).index(actor.kind)
+            row["rect"] = tuple(actor.rect)
+            row["prev"], row["home"], row["v"] = actor.prev, actor.home, (actor.vx, actor.vy)
+            row["bound"], row["has_bound"] = actor.bound or 0, actor.bound is not None
+            row["stopped"], row["interval"] = actor.state == "stop", actor.interval
+            row["live"], row["order"] = actor.live, actor.order
+            row["bomb"] = -1 if actor.bomb is None else kind_ids[actor.bomb]
+            row["on_stop"] = actor.on_stop is not None
+            row["flipped"] = actor.image is actor.image2 and actor.spec["flip"]
+        meta = json.dumps({"images": [ASSETS.key(img) for img in shots.images], "patterns": patterns}).encode()
+        version, state, gauss = self.rng.getstate()
+        n = shots.n
+        header = SNAPSHOT_HEADER.pack(
+            b"KKTS", 2, self.waves_crc, self.seed,
+            self.tmr, self.x, self.spawned, score.score, score.text.size, *score.rect.center,
+            self.boss_hp.life, self.boss_hp.now_life, self.boss_attack, self.invincible,
+            SNAPSHOT_RESULTS.index(self.result), self.scheduler.seq, self.scheduler.fired,
+            *aircraft.rect, *aircraft.prev, *aircraft.dire, aircraft.speed, aircraft.state == "hyper",
+            aircraft.hyper_life, aircraft.hyper_frames, aircraft.flash,
+            n, shots.next_uid, len(actors), len(events), len(pierced), exps.n, len(meta),
+            gauss is not None, gauss or 0.0)
+        parts = [header, np.array(state, np.uint32).tobytes(), meta]
+        parts += [getattr(shots, name)[:n].tobytes() for name, _ in SNAPSHOT_SHOT]
+        parts += [rows.tobytes(), events.tobytes(), pierced.tobytes()]
+        parts += [getattr(exps, name)[:exps.n].tobytes() for name, _ in SNAPSHOT_EFFECT]
+        return b"".join(parts)
+
+    def restore(self, data: bytes):
+        """
+        snapshotで作ったバイト列の状態に戻す（同じウェーブ定義のGameでなければならない）
+        引数 data：snapshotの戻り値
+        """
+        (magic, version, waves_crc, seed,
+         tmr, x, spawned, score, score_size, score_x, score_y, life, now_life, boss_attack, invincible,
+         result, seq, fired,
+         ax, ay, aw, ah, px, py, dire_x, dire_y, speed, hyper, hyper_life, hyper_frames, flash,
+         n, next_uid, n_actors, n_events, n_pierced, n_exps, n_meta,
+         has_gauss, gauss) = SNAPSHOT_HEADER.unpack_from(data)
+        if magic != b"KKTS" or version != 2:
+            raise ValueError("ゲームの状態のスナップショットではありません")
+        if waves_crc != self.waves_crc:
+            raise ValueError("スナップショットとウェーブ定義が違います")
+        pos = SNAPSHOT_HEADER.size
+
+        def take(dtype, count):
+            nonlocal pos
+            arr = np.frombuffer(data, dtype, count, pos)
+            pos += arr.nbytes
+            return arr
+
+        self.seed = seed
+        self.rng.setstate((3, tuple(take(np.uint32, 625).tolist()), gauss if has_gauss else None))
+        meta = json.loads(data[pos:pos+n_meta])
+        pos += n_meta
+        self.tmr, self.x, self.spawned = tmr, x, spawned
+        self.boss_attack, self.invincible = bool(boss_attack), bool(invincible)
+        self.result = SNAPSHOT_RESULTS[result]
+        self.score.score = score
+        if score_size != self.score.text.size:
+            self.score.set_size(score_size)
+        self.score.rect.center = score_x, score_y
+        self.boss_hp.life, self.boss_hp.now_life = life, now_life
+        aircraft = self.aircraft
+        aircraft.rect = pg.Rect(ax, ay, aw, ah)
+        aircraft.prev, aircraft.dire, aircraft.speed = (px, py), (dire_x, dire_y), speed
+        aircraft.state = "hyper" if hyper else "nomal"
+        aircraft.hyper_life, aircraft.hyper_frames, aircraft.flash = hyper_life, hyper_frames, bool(flash)
+        if hyper_frames:
+            frames = ASSETS.strip("ex05/fig/sentouki.png", "laplacian", 501, 0, 0.25)
+            aircraft.img = frames[min(hyper_frames, len(frames)-1)]
         else:
-            emys.update()
-            emys.draw(screen)
-        aircraft.update(key_lst, screen)
-        beams.update()
-        beams.draw(screen)
-        charge_beam.update()
-        charge_beam.draw(screen)
-        bombs.update()
-        bombs.draw(screen)
-        exps.update()
-        exps.draw(screen)
-        score.update(screen)
-        beam_status.update(screen, x)
-        if score.score > 20 and boss_attack==False:
-            boss_attack = True
-            boss.add(Boss())
-            s_boss.add(S_Boss(200))
-            s_boss.add(S_Boss(1200))
-        if boss_hp.now_life<1:
-            score.update(screen)
-            pg.display.update()
-            time.sleep(2)
+            aircraft.img = ASSETS.image("ex05/fig/sentouki.png", 0, 0.25)
+
+        shots = self.shots
+        if shots.capacity < n:
+            shots.n = 0
+            shots.alloc(max(n, 256))
+        for name, dtype in SNAPSHOT_SHOT:
+            getattr(shots, name)[:n] = take(dtype, n)
+        shots.live[n:] = False
+        shots.n, shots.next_uid = n, next_uid
+        shots.images = [ASSETS.by_key(key) for key in meta["images"]]
+        shots.image_ids = {img: i for i, img in enumerate(shots.images)}
+        shots.areas, shots.atlas = [], None  # 画像番号が変わったので，Atlasの範囲は引き直す
+        shots.counts = np.bincount(shots.kind[:n][shots.live[:n]], minlength=len(shots.kinds)).tolist()
+        shots.refs.clear()
+
+        kinds = list(ACTOR_KINDS)
+        actors = []
+        for row in take(SNAPSHOT_ACTOR, n_actors).tolist():
+            kind, rect, prev, home, v, bound, has_bound, stopped, interval, live, order, bomb, on_stop, flipped = row
+            actor = object.__new__(Actor)
+            spec = actor.spec = ACTOR_KINDS[kinds[kind]]
+            actor.kind = kinds[kind]
+            actor.image2 = actor.image = ASSETS.image(*spec["image"])
+            if spec["flip"]:
+                actor.image2 = ASSETS.image(*spec["image"], flip=(True, False))
+            if flipped:
+                actor.image = actor.image2
+            actor.rect = pg.Rect(rect)
+            actor.prev, actor.home = tuple(prev), tuple(home)
+            actor.vx, actor.vy = v
+            actor.bound = bound if has_bound else None
+            actor.state = "stop" if stopped else "down"
+            actor.interval, actor.live, actor.order = interval, live, order
+            actor.bomb = None if bomb < 0 else shots.kinds[bomb]
+            actor.on_stop = self.enemy_stopped if on_stop else None
+            actors.append(actor)
+        self.actors.items = actors
+
+        patterns = []
+        for spec in meta["patterns"]:
+            spec = dict(spec)
+            pattern = object.__new__(PATTERNS[spec.pop("type")])
+            pattern.__dict__.update(spec)
+            patterns.append(pattern)
+        waves = self.waves["enemies"]
+        queue = []
+        for tick, priority, seq_, func, args in take(SNAPSHOT_EVENT, n_events).tolist():
+            if SNAPSHOT_FUNCS[func] == "spawn_enemy":
+                queue.append((tick, priority, seq_, self.spawn_enemy, (waves[args[0]], args[1])))
+            else:
+                emy, bomb, every, p = args
+                queue.append((tick, priority, seq_, self.attack,
+                              (actors[emy], shots.kinds[bomb], every, None if p < 0 else patterns[p])))
+        heapq.heapify(queue)
+        self.scheduler.queue, self.scheduler.seq, self.scheduler.fired = queue, seq, fired
+
+        def obj(key):
+            return key if key >= 0 else aircraft if key == -1 else actors[-2-key]
+        pierced = {}
+        for k, hit in take(np.int64, 2*n_pierced).reshape(-1, 2).tolist():
+            pierced.setdefault(obj(k), set()).add(obj(hit))
+        self.collisions.pierced = pierced
+
+        exps = self.exps
+        for name, dtype in SNAPSHOT_EFFECT:
+            getattr(exps, name)[:n_exps] = take(dtype, n_exps)
+        exps.n = n_exps
+
+    def draw(self, screen: pg.Surface, bg_img: pg.Surface, alpha: float = 1.0):
+        """
+        ゲームの状態を描画する
+        引数1 screen：画面SurfaceまたはDirtyScreen
+        引数2 bg_img：背景画像Surface（Noneなら背景を描かない）
+        引数3 alpha：前のティックから次のティックまでの経過割合
+        """
+        prof = self.prof
+        if bg_img is not None:
+            screen.blit(bg_img, [0, 0])
+        self.actors.draw(screen, self.phase, alpha)
+        self.aircraft.draw(screen, alpha)
+        self.shots.draw(screen, alpha)
+        self.exps.draw(screen)
+        if prof:
+            prof.lap("draw")
+        refresh = self.frames%self.quality["hud_every"] == 0
+        self.frames += 1
+        if self.boss_attack:
+            self.boss_hp.update(screen, refresh)
+        self.score.update(screen, refresh)
+        self.beam_status.update(screen, self.x)
+        if prof:
+            prof.lap("hud")
+
+    def draw_result(self, screen: pg.Surface, bg_img: pg.Surface):
+        """
+        ゲーム終了時の画面を描画する
+        """
+        if self.result == "dead":
+            screen.blit(bg_img, [0, 0])
+            self.aircraft.change_img(screen) # 戦闘機爆発エフェクト
+        else:
+            self.draw(screen, bg_img)
+        self.score.update(screen)
+
+
+class Rewind:
+    """
+    直近のゲームの状態のスナップショットをリングバッファに取っておき，巻き戻せるようにするクラス
+    """
+    def __init__(self, capacity: int = 100, every: int = 5):
+        """
+        引数1 capacity：取っておくスナップショットの数（古いものから捨てる）
+        引数2 every：スナップショットを取るティック間隔
+        """
+        self.every = every
+        self.snaps = deque(maxlen=capacity)  # (ティック, スナップショット)
+
+    def __len__(self):
+        return len(self.snaps)
+
+    def record(self, game: Game):
+        """
+        everyティックごとにgameの状態を取っておく（毎ティック呼ぶ）
+        """
+        if game.tmr%self.every == 0 and (not self.snaps or self.snaps[-1][0] != game.tmr):
+            self.snaps.append((game.tmr, game.snapshot()))
+
+    def rewind(self, game: Game, ticks: int) -> int:
+        """
+        gameを，ticksティック以上前の取っておいた状態のうち最も新しいものに戻す
+        それより新しいスナップショットは捨てる（足りなければ一番古い状態に戻す）
+        戻り値：戻したティック（取っておいた状態がなければ今のティック）
+        """
+        snaps = self.snaps
+        while len(snaps) > 1 and snaps[-1][0] > game.tmr-ticks:
+            snaps.pop()
+        if snaps:
+            game.restore(snaps[-1][1])
+        return game.tmr
+
+
+class Replay:
+    """
+    乱数の種とティックごとの入力を記録し，同じゲームを再生するためのクラス
+    入力は1ティックにつき，押し続けているキーのビット列と押されたキーの数の2バイトと，
+    押されたキーの番号（1つ1バイト）で記録する
+    """
+    magic = b"KKTR"
+    header = struct.Struct("<4sIQIII")  # 識別子，版，乱数の種，ティックレート，ティック数，チェックサム
+
+    def __init__(self, seed: int, tick_rate: int = 50):
+        """
+        引数1 seed：ゲームの乱数の種
+        引数2 tick_rate：記録したときの1秒あたりのティック数
+        """
+        self.seed = seed
+        self.tick_rate = tick_rate
+        self.data = bytearray()
+        self.ticks = 0
+        self.checksum = 0  # 記録を終えたときのGame.checksum()
+
+    def __len__(self):
+        return self.ticks
+
+    def record(self, controls: Controls):
+        """
+        1ティック分の入力を記録する
+        """
+        bits = 0
+        for i, key in enumerate(Controls.keys):
+            if key in controls.held:
+                bits |= 1 << i
+        self.data += bytes([bits, len(controls.presses)])
+        self.data += bytes(Controls.actions.index(key) for key in controls.presses)
+        self.ticks += 1
+
+    def truncate(self, ticks: int):
+        """
+        記録を最初のticksティック分だけにする（巻き戻したときに使う）
+        """
+        data = self.data
+        i = 0
+        for _ in range(min(ticks, self.ticks)):
+            i += 2+data[i+1]
+        del data[i:]
+        self.ticks = min(ticks, self.ticks)
+
+    def __iter__(self):
+        """
+        記録した入力をティックごとのControlsとして順に返す
+        """
+        data = self.data
+        i = 0
+        for _ in range(self.ticks):
+            bits, n = data[i], data[i+1]
+            held = [key for j, key in enumerate(Controls.keys) if bits >> j & 1]
+            presses = [Controls.actions[code] for code in data[i+2:i+2+n]]
+            i += 2+n
+            yield Controls(held, presses)
+
+    def save(self, path: str):
+        with open(path, "wb") as f:
+            f.write(self.header.pack(self.magic, 1, self.seed, self.tick_rate, self.ticks, self.checksum))
+            f.write(zlib.compress(bytes(self.data)))
+
+    @classmethod
+    def load(cls, path: str) -> "Replay":
+        with open(path, "rb") as f:
+            buf = f.read()
+        magic, version, seed, tick_rate, ticks, checksum = cls.header.unpack_from(buf)
+        if magic != cls.magic or version != 1:
+            raise ValueError(f"{path}はリプレイファイルではありません")
+        replay = cls(seed, tick_rate)
+        replay.data = bytearray(zlib.decompress(buf[cls.header.size:]))
+        replay.ticks = ticks
+        replay.checksum = checksum
+        return replay
+
+
+def random_policy(rng: random.Random):
+    """
+    ランダムに操作する入力関数を返す
+    引数 rng：操作を決める乱数生成器
+    戻り値：Gameを受け取り，そのティックのControlsを返す関数
+    """
+    def policy(game: Game) -> Controls:
+        held = [k for k in (pg.K_LEFT, pg.K_RIGHT) if rng.random() < 0.5]
+        presses = []
+        if rng.random() < 0.2:
+            presses.append(pg.K_SPACE)
+        if rng.random() < 0.05:
+            presses.append(pg.K_ESCAPE)
+        if rng.random() < 0.01:
+            presses.append(pg.K_RSHIFT)
+        return Controls(held, presses)
+    return policy
+
+
+def scripted_policy(script):
+    """
+    決められた入力を順番に返す入力関数を返す
+    引数 script：ティックごとのControlsのイテラブル（尽きたら何も押さない）
+    戻り値：Gameを受け取り，そのティックのControlsを返す関数
+    """
+    it = iter(script)
+    return lambda game: next(it, Controls())
+
+
+def init_headless():
+    """
+    画面を開かずにゲームを動かせるようにpygameを初期化する
+    """
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+    if not pg.get_init():
+        pg.init()
+
+
+def run_headless(seed: int = None, policy=None, max_ticks: int = 15000, waves: dict = None,
+                 state: str = None) -> dict:
+    """
+    描画・待ち時間なしでゲームを1回最後まで進める
+    引数1 seed：乱数の種（Noneなら固定しない）
+    引数2 policy：Gameを受け取りControlsを返す入力関数（Noneならランダムに操作する）
+    引数3 max_ticks：打ち切るティック数
+    引数4 waves：ウェーブ定義（Noneなら既定のウェーブ）
+    引数5 state：終わったときの状態のスナップショットを書き出すパス（Noneなら書き出さない）
+    戻り値：スコア，進んだティック数，結果，ボスを倒したか，終了時のチェックサムの辞書
+    """
+    init_headless()
+    game = Game(seed, waves)
+    if policy is None:
+        policy = random_policy(random.Random(game.seed+1))
+    while game.result is None and game.tmr < max_ticks:
+        game.step(policy(game))
+    save_state(game, state)
+    return {
+        "seed": game.seed,
+        "score": game.score.score,
+        "ticks": game.tmr,
+        "result": game.result or "timeout",
+        "boss_killed": game.result == "clear",
+        "checksum": game.checksum(),
+    }
+
+
+def run_replay(replay: Replay, waves: dict = None, state: str = None) -> dict:
+    """
+    記録したゲームを描画・待ち時間なしで再生する
+    引数1 replay：再生するReplay
+    引数2 waves：記録したときと同じウェーブ定義
+    引数3 state：再生し終えたときの状態のスナップショットを書き出すパス
+    戻り値：run_headlessの結果に，記録と一致したか（"match"）を加えた辞書
+    """
+    result = run_headless(replay.seed, scripted_policy(replay), len(replay), waves, state)
+    result["match"] = result["checksum"] == replay.checksum
+    return result
+
+
+def check_replays(games: int, max_ticks: int = 3000, seed: int = 0, waves: dict = None) -> bool:
+    """
+    ランダム操作のゲームを記録し，ファイルに保存・読み込みした記録を再生して，終了時のチェックサムが一致するかを調べる
+    引数1 games：ゲーム数
+    引数2 max_ticks：1ゲームを打ち切るティック数
+    引数3 seed：最初のゲームの乱数の種（ゲームごとに1ずつ増やす）
+    引数4 waves：ウェーブ定義（Noneなら既定のウェーブ）
+    戻り値：すべてのゲームで一致したらTrue
+    """
+    init_headless()
+    ok = True
+    with tempfile.TemporaryDirectory() as folder:
+        for s in range(seed, seed+games):
+            game = Game(s, waves)
+            policy = random_policy(random.Random(s+1))
+            replay = Replay(s)
+            while game.result is None and game.tmr < max_ticks:
+                controls = policy(game)
+                replay.record(controls)
+                game.step(controls)
+            replay.checksum = game.checksum()
+            path = os.path.join(folder, f"{s}.rep")
+            replay.save(path)
+            match = run_replay(Replay.load(path), waves)["match"]
+            ok = ok and match
+            print(f"seed {s:<6}ticks {len(replay):<7}checksum {replay.checksum:08x}  "
+                  f"replay: {'ok' if match else 'MISMATCH'}")
+    return ok
+
+
+def check_snapshots(games: int, max_ticks: int = 3000, seed: int = 0, waves: dict = None, points: int = 4) -> bool:
+    """
+    無敵の戦闘機をランダムに操作したゲームの途中でスナップショットを取り，
+    restoreしてもう一度snapshotすると同じバイト列になるか，
+    restoreしてから同じ入力で続けると，通して進めたときと同じチェックサムで終わるかを調べる
+    新しいGameへのrestoreと，最後まで進めたGameへのrestore（巻き戻し）の両方で調べる
+    引数1 games：ゲーム数
+    引数2 max_ticks：1ゲームを打ち切るティック数
+    引数3 seed：最初のゲームの乱数の種（ゲームごとに1ずつ増やす）
+    引数4 waves：ウェーブ定義（Noneなら既定のウェーブ）
+    引数5 points：1ゲームでスナップショットを取る回数
+    戻り値：すべて一致したらTrue
+    """
+    init_headless()
+    every = max(1, max_ticks//points)
+    ok = True
+    for s in range(seed, seed+games):
+        game = Game(s, waves)
+        game.invincible = True
+        policy = random_policy(random.Random(s+1))
+        script = []
+        snaps = []  # (入力の番号, スナップショット)
+        while game.result is None and game.tmr < max_ticks:
+            if game.tmr%every == 0:
+                snaps.append((len(script), game.snapshot()))
+            script.append(policy(game))
+            game.step(script[-1])
+        end = game.tmr, game.checksum()
+        fails = 0
+        for i, data in snaps:
+            for target in (Game(s, waves), game):
+                target.restore(data)
+                same = target.snapshot() == data
+                for controls in script[i:]:
+                    if target.result is not None:
+                        break
+                    target.step(controls)
+                fails += not same or (target.tmr, target.checksum()) != end
+        ok = ok and fails == 0
+        print(f"seed {s:<6}ticks {end[0]:<7}phase {game.phase:<6}snapshots {len(snaps)}  "
+              f"restore: {'ok' if fails == 0 else f'{fails} MISMATCH'}")
+    return ok
+
+
+def check_pierce(waves: dict = None) -> bool:
+    """
+    ボスの真下から撃ったチャージビーム・スーパービームが，ボスを貫通しても1本につき1回だけボスに当たるかを調べる
+    当たった直後にスナップショットから新しいGameに戻して続けても，当たった相手の記録が戻って二度当たらないかも調べる
+    引数 waves：ウェーブ定義（Noneなら既定のウェーブ）
+    戻り値：すべて1回だけ当たったらTrue
+    """
+    init_headless()
+    ok = True
+    for charges in (10, 20):  # チャージビーム，スーパービーム
+        for restore in (False, True):
+            game = Game(0, waves)
+            game.invincible = True
+            game.start_boss()
+            boss = game.actors.of("Boss")[0]
+            game.aircraft.rect.centerx = boss.rect.centerx
+            game.x = charges
+            life = game.boss_hp.now_life
+            game.step(Controls(presses=[pg.K_SPACE]))
+            restored = False
+            while game.shots.count("charge_beam") and game.tmr < 500:
+                game.step(Controls())
+                if restore and not restored and game.boss_hp.now_life < life:
+                    data = game.snapshot()
+                    game = Game(0, waves)
+                    game.restore(data)
+                    restored = True
+            hits = life-game.boss_hp.now_life
+            ok = ok and hits == 1
+            print(f"charges {charges:<4}restored {'yes' if restored else 'no':<5}boss hits {hits}  "
+                  f"pierce: {'ok' if hits == 1 else 'MISMATCH'}")
+    return ok
+
+
+def run_batch(games: int, workers: int = None, max_ticks: int = 15000, seed: int = 0,
+              waves: dict = None) -> list[dict]:
+    """
+    ランダム操作のゲームを複数のプロセスで並列にgames回進める
+    引数1 games：ゲーム数
+    引数2 workers：プロセス数（Noneならコア数）
+    引数3 max_ticks：1ゲームを打ち切るティック数
+    引数4 seed：最初のゲームの乱数の種（ゲームごとに1ずつ増やす）
+    引数5 waves：ウェーブ定義（Noneなら既定のウェーブ）
+    戻り値：ゲームごとのrun_headlessの結果のリスト
+    """
+    seeds = range(seed, seed+games)
+    with ProcessPoolExecutor(workers) as pool:
+        return list(pool.map(run_headless, seeds, [None]*games, [max_ticks]*games, [waves]*games,
+                             chunksize=max(1, games//(8*(workers or os.cpu_count() or 1)))))
+
+
+def run_soak(ticks: int, interval: int = 5000, seed: int = 0, render: bool = False, waves: dict = None,
+             tracker: MemoryTracker = None) -> dict:
+    """
+    描画なし（renderなら画面外に描画）で無敵の戦闘機をランダムに操作してticksティック進め，メモリを記録する
+    ゲームが終わったら次の種で新しいゲームを始める
+    引数1 ticks：進めるティック数
+    引数2 interval：メモリを記録するティック間隔
+    引数3 seed：最初のゲームの乱数の種
+    引数4 render：毎ティック画面外のSurfaceに描画するか
+    引数5 waves：ウェーブ定義（Noneなら既定のウェーブ）
+    引数6 tracker：記録に使うMemoryTracker（Noneなら作る）
+    戻り値：MemoryTracker.reportの辞書に，遊んだゲーム数（"games"）を加えたもの
+    """
+    init_headless()
+    ASSETS.preload(ASSET_MANIFEST)  # 画像のキャッシュが埋まっていくのを増加と数えないように先に作る
+    tracker = tracker or MemoryTracker(interval)
+    screen = pg.Surface((WIDTH, HEIGHT)) if render else None
+    bg_img = ASSETS.image("ex05/fig/pg_bg.jpg")
+    game = None
+    games = 0
+    tracker.start()
+    for tick in range(1, ticks+1):
+        if game is None or game.result is not None:
+            game = Game(seed+games, waves)
+            game.invincible = True
+            policy = random_policy(random.Random(game.seed))
+            games += 1
+        game.step(policy(game))
+        if render:
+            game.draw(screen, bg_img)
+        if tick%tracker.interval == 0:
+            tracker.print_sample(tracker.sample(tick))
+    report = tracker.report()
+    tracker.stop()
+    report["games"] = games
+    return report
+
+
+def action_controls(action: int) -> Controls:
+    """
+    行動の番号を1ティック分の入力にする
+    下位ビットから順にControls.keysを押し続けるか，その上のビットがControls.actionsを押すか
+    引数 action：0以上GameEnv.action_count未満の整数
+    戻り値：行動に当たるControls
+    """
+    held = [key for i, key in enumerate(Controls.keys) if action >> i & 1]
+    presses = [key for i, key in enumerate(Controls.actions, len(Controls.keys)) if action >> i & 1]
+    return Controls(held, presses)
+
+
+class GameEnv:
+    """
+    ボットの学習・評価のために，Gameを画面なしでreset()/step(action)で進める環境（Gymnasiumと同じ形）
+    観測は特徴量の配列（"features"）か，縮小した画面（"pixels"）のどちらか
+    報酬はそのステップで増えたスコアで，やられるかボスを倒したら終わる
+    """
+    action_count = 1 << (len(Controls.keys)+len(Controls.actions))  # 行動の数
+    near_shots = 16  # 特徴量に入れる近い爆弾の数
+    near_actors = 8  # 特徴量に入れる近い敵の数
+    feature_size = 8+6*near_shots+4*near_actors
+
+    def __init__(self, obs: str = "features", seed: int = None, max_ticks: int = 15000, frame_skip: int = 1,
+                 scale: int = 8, waves: dict = None, out: np.ndarray = None, seed_step: int = 1):
+        """
+        引数1 obs：観測の形式（"features"または"pixels"）
+        引数2 seed：最初のゲームの乱数の種（resetのたびにseed_stepずつ増やす，Noneなら毎回適当に決める）
+        引数3 max_ticks：1ゲームを打ち切るティック数
+        引数4 frame_skip：1ステップで進めるティック数（押した瞬間のキーは最初のティックだけ）
+        引数5 scale："pixels"で画面を縮める割合（scaleピクセルごとに1ピクセルを取り出す）
+        引数6 waves：ウェーブ定義（Noneなら既定のウェーブ）
+        引数7 out：観測を書き込む配列（Noneなら作る，VecGameEnvの共有メモリを渡す）
+        引数8 seed_step：resetのたびに乱数の種に足す数（VecGameEnvはゲーム数にして，ゲームどうしで種が重ならないようにする）
+        """
+        init_headless()
+        self.obs_type = obs
+        self.seed = seed
+        self.seed_step = seed_step
+        self.max_ticks = max_ticks
+        self.frame_skip = frame_skip
+        self.scale = scale
+        self.waves = waves
+        shape, dtype = self.obs_spec(obs, scale)
+        self.out = np.zeros(shape, dtype) if out is None else out
+        self.frame = None  # "pixels"で描画する画面外のSurface
+        self.game = None
+
+    @staticmethod
+    def obs_spec(obs: str, scale: int = 8) -> tuple[tuple[int, ...], type]:
+        """
+        戻り値：観測の配列の形と型
+        """
+        if obs == "features":
+            return (GameEnv.feature_size,), np.float32
+        if obs == "pixels":
+            return (-(-HEIGHT//scale), -(-WIDTH//scale), 3), np.uint8
+        raise ValueError(f"観測の形式{obs}はありません")
+
+    def reset(self, seed: int = None) -> tuple[np.ndarray, dict]:
+        """
+        新しいゲームを始める
+        引数 seed：乱数の種（Noneなら前のゲームの種にseed_stepを足したもの）
+        戻り値：最初の観測と情報の辞書
+        """
+        if seed is not None:
+            self.seed = seed
+        self.game = Game(self.seed, self.waves)
+        if self.seed is not None:
+            self.seed += self.seed_step
+        return self.observe(), self.info()
+
+    def step(self, action: int) -> tuple[np.ndarray, float, bool, bool, dict]:
+        """
+        行動をframe_skipティック続けてゲームを進める
+        引数 action：行動の番号（action_controlsを参照）
+        戻り値：観測，報酬，ゲームが終わったか，打ち切ったか，情報の辞書
+        """
+        game = self.game
+        controls = action_controls(action)
+        score = game.score.score
+        for i in range(self.frame_skip):
+            game.step(controls if i == 0 else Controls(controls.held))
+            if game.result is not None or game.tmr >= self.max_ticks:
+                break
+        terminated = game.result is not None
+        truncated = not terminated and game.tmr >= self.max_ticks
+        return self.observe(), float(game.score.score-score), terminated, truncated, self.info()
+
+    def info(self) -> dict:
+        game = self.game
+        return {"score": game.score.score, "ticks": game.tmr, "result": game.result,
+                "boss_hp": game.boss_hp.now_life, "phase": game.phase}
+
+    def observe(self) -> np.ndarray:
+        """
+        今の状態の観測をoutに書き込む
+        戻り値：out（次のstep・resetで書き換わる）
+        """
+        if self.obs_type == "features":
+            self.features(self.out)
+        else:
+            self.pixels(self.out)
+        return self.out
+
+    def features(self, out: np.ndarray):
+        """
+        戦闘機の状態と，戦闘機に近い順の爆弾・敵の相対位置などを特徴量としてoutに書き込む
+        位置は画面の幅・高さで，速さは20で割って大きさをそろえる
+        戦闘機：x，y，無敵か，無敵の残り，チャージ回数，スコア，ボス戦か，ボスのHPの割合
+        爆弾（near_shots個）：いるか，相対x，相対y，x方向の速さ，y方向の速さ，半径
+        敵（near_actors個）：いるか，相対x，相対y，種類（ACTOR_KINDSの順番+1）
+        """
+        game = self.game
+        aircraft = game.aircraft
+        ax, ay = aircraft.rect.center
+        boss = game.waves["boss"]["hp"]
+        out[:8] = (ax/WIDTH, ay/HEIGHT, aircraft.state == "hyper", max(aircraft.hyper_life, 0)/500, game.x/20,
+                   game.score.score/1000, game.boss_attack, game.boss_hp.now_life/boss)
+        out[8:] = 0
+        shots = game.shots
+        n = shots.n
+        hostile = np.array([SHOT_KINDS[name]["faction"] == "enemy" for name in shots.kinds])
+        idx = np.flatnonzero(shots.live[:n] & hostile[shots.kind[:n]])
+        if len(idx):
+            rx = (shots.x[idx]+shots.w[idx]//2-ax)/WIDTH
+            ry = (shots.y[idx]+shots.h[idx]//2-ay)/HEIGHT
+            near = np.argsort(rx*rx+ry*ry, kind="stable")[:self.near_shots]
+            idx = idx[near]
+            rows = out[8:8+6*self.near_shots].reshape(self.near_shots, 6)[:len(idx)]
+            rows[:, 0] = 1
+            rows[:, 1], rows[:, 2] = rx[near], ry[near]
+            rows[:, 3], rows[:, 4] = shots.dx[idx]/20, shots.dy[idx]/20
+            rows[:, 5] = np.maximum(shots.w[idx], shots.h[idx])/2/WIDTH
+        kinds = list(ACTOR_KINDS)
+        actors = [(actor.rect.centerx-ax, actor.rect.centery-ay, kinds.index(actor.kind)+1)
+                  for actor in game.actors if actor.live and actor.spec["phase"] == game.phase]
+        actors.sort(key=lambda a: a[0]*a[0]+a[1]*a[1])
+        rows = out[8+6*self.near_shots:].reshape(self.near_actors, 4)
+        for row, (rx, ry, kind) in zip(rows, actors):
+            row[:] = 1, rx/WIDTH, ry/HEIGHT, kind
+
+    def pixels(self, out: np.ndarray):
+        """
+        画面外のSurfaceにゲームを描画し，scaleピクセルごとに取り出した画素をoutに書き込む
+        pg.surfarray.pixels3dで描画したSurfaceの画素を直接読むので，画面全体をコピーしない
+        """
+        if self.frame is None:
+            self.frame = pg.Surface((WIDTH, HEIGHT))
+        self.game.draw(self.frame, ASSETS.image("ex05/fig/pg_bg.jpg"))
+        view = pg.surfarray.pixels3d(self.frame)  # 描画中はロックできないので毎回作って捨てる
+        out[...] = view[::self.scale, ::self.scale].transpose(1, 0, 2)
+        del view
+
+
+def env_worker(conn, shm_name: str, shape: tuple[int, ...], dtype: type, ids: list[int], options: dict):
+    """
+    VecGameEnvのプロセスで，担当するゲームを親プロセスの命令どおりに進める
+    観測は共有メモリの配列の，担当するゲームの行に直接書き込む
+    """
+    shm = shared_memory.SharedMemory(name=shm_name)
+    obs = np.ndarray(shape, dtype, buffer=shm.buf)
+    seed = options.pop("seed")
+    envs = [GameEnv(seed=None if seed is None else seed+i, out=obs[i], **options) for i in ids]
+    while True:
+        cmd, data = conn.recv()
+        if cmd == "reset":
+            conn.send([env.reset(None if data is None else data+i)[1] for i, env in zip(ids, envs)])
+        elif cmd == "step":
+            results = []
+            for env, action in zip(envs, data):
+                _, reward, terminated, truncated, info = env.step(action)
+                if terminated or truncated:  # 終わったゲームはすぐに次のゲームを始める
+                    info["final_obs"] = env.out.copy()
+                    env.reset()
+                results.append((reward, terminated, truncated, info))
+            conn.send(results)
+        else:
+            break
+    del obs, envs
+    shm.close()
+    conn.close()
+
+
+class VecGameEnv:
+    """
+    n個の独立したゲームを複数のプロセスで同時に1ステップずつ進める環境
+    観測は共有メモリ上の(n, 観測の形)の配列に各プロセスが直接書き込むので，プロセス間で観測を送らない
+    終わったゲームはそのステップのうちに次のゲームを始め，最後の観測はinfoの"final_obs"に入れる
+    """
+    def __init__(self, n: int, workers: int = None, obs: str = "features", seed: int = 0, **options):
+        """
+        引数1 n：ゲーム数
+        引数2 workers：プロセス数（Noneならコア数，n以下）
+        引数3 obs：観測の形式（GameEnvを参照）
+        引数4 seed：i番目のゲームのk回目のゲームの乱数の種はseed+i+k*n（Noneなら固定しない）
+        引数5 options：GameEnvのそのほかの引数
+        """
+        self.n = n
+        shape, dtype = GameEnv.obs_spec(obs, options.get("scale", 8))
+        shape = (n, *shape)
+        self.shm = shared_memory.SharedMemory(create=True, size=max(1, int(np.prod(shape))*np.dtype(dtype).itemsize))
+        self.obs = np.ndarray(shape, dtype, buffer=self.shm.buf)
+        workers = max(1, min(n, workers or os.cpu_count() or 1))
+        self.groups = [ids.tolist() for ids in np.array_split(np.arange(n), workers)]
+        self.conns = []
+        self.procs = []
+        for ids in self.groups:
+            conn, child = Pipe()
+            proc = Process(target=env_worker, args=(child, self.shm.name, shape, dtype, ids,
+                                                    {"obs": obs, "seed": seed, "seed_step": n, **options}),
+                            daemon=True)
+            proc.start()
+            child.close()
+            self.conns.append(conn)
+            self.procs.append(proc)
+
+    def __len__(self):
+        return self.n
+
+    def reset(self, seed: int = None) -> tuple[np.ndarray, list[dict]]:
+        """
+        すべてのゲームを始め直す
+        引数 seed：i番目のゲームの乱数の種をseed+iにする（Noneなら前の種の続き，以後もゲームどうしで重ならない）
+        戻り値：観測の配列（共有メモリ，次のstep・resetで書き換わる）と，ゲームごとの情報のリスト
+        """
+        for conn in self.conns:
+            conn.send(("reset", seed))
+        return self.obs, [info for conn in self.conns for info in conn.recv()]
+
+    def step(self, actions) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, list[dict]]:
+        """
+        すべてのゲームを1ステップ進める（全プロセスに送ってからまとめて受け取る）
+        引数 actions：ゲームごとの行動の番号の列
+        戻り値：観測の配列，報酬・終わったか・打ち切ったかの配列，ゲームごとの情報のリスト
+        """
+        actions = [int(action) for action in actions]
+        for conn, ids in zip(self.conns, self.groups):
+            conn.send(("step", actions[ids[0]:ids[-1]+1]))
+        results = [result for conn in self.conns for result in conn.recv()]
+        rewards, terminated, truncated, infos = zip(*results)
+        return (self.obs, np.array(rewards, np.float32), np.array(terminated), np.array(truncated),
+                list(infos))
+
+    def close(self):
+        """
+        プロセスを終わらせ，共有メモリを解放する
+        """
+        if self.shm is None:
             return
-        pg.display.update()
-        tmr += 1
-        clock.tick(50)
+        for conn in self.conns:
+            conn.send(("close", None))
+            conn.close()
+        for proc in self.procs:
+            proc.join()
+        del self.obs
+        self.shm.close()
+        self.shm.unlink()
+        self.shm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class BenchEmitter(pg.sprite.Sprite):
+    """
+    ベンチマークで爆弾を投下させる位置だけを持つスプライト
+    """
+    def __init__(self, xy: tuple[int, int]):
+        super().__init__()
+        self.rect = pg.Rect(0, 0, 48, 48)
+        self.rect.center = xy
+
+
+def bench_idle(game: Game):
+    """
+    何も加えずに進める場面（--bench-stateで保存した状態をそのまま進めるのに使う）
+    """
+
+
+def bench_enemies(game: Game):
+    """
+    敵機500体が降下・停止・爆弾投下する場面
+    """
+    for _ in range(500):
+        game.add_enemy(Actor("Enemy", game.rng))
+
+
+def bench_bombs(game: Game, count: int = 5000):
+    """
+    戦闘機を狙うcount個の爆弾が常に画面にある場面
+    """
+    rng = game.rng
+    emitters = [BenchEmitter((rng.randint(0, WIDTH), rng.randint(100, 300))) for _ in range(50)]
+
+    def tick(game: Game) -> Controls:
+        while game.shots.count("bomb") < count:
+            spawn_shot(game.shots, "bomb", rng.choice(emitters), game.aircraft, rng)
+        return Controls()
+    return tick
+
+
+def bench_boss(game: Game):
+    """
+    ボス戦で，2体の小ボスが毎ティック攻撃する場面
+    """
+    game.start_boss()
+
+    def tick(game: Game) -> Controls:
+        for bos in game.actors.of("S_Boss"):
+            spawn_shot(game.shots, "small_bomb", bos, game.aircraft, game.rng)
+        return Controls()
+    return tick
+
+
+def bench_patterns(game: Game):
+    """
+    ボスが4ティックに1回200発の全方向弾を，小ボスが毎ティック渦巻きと扇形の弾幕を撃つ場面
+    """
+    game.start_boss()
+    radial = Radial(200)
+    spirals = [Spiral(6, turn=9), Fan(9, spread=90)]
+
+    def tick(game: Game) -> Controls:
+        if game.tmr%4 == 0:
+            for bos in game.actors.of("Boss"):
+                radial.fire(game.shots, "boss_bomb", bos, game.aircraft, game.rng)
+        for bos, pattern in zip(game.actors.of("S_Boss"), spirals):
+            pattern.fire(game.shots, "small_bomb", bos, game.aircraft, game.rng)
+        return Controls()
+    return tick
+
+
+def bench_charge_sweep(game: Game):
+    """
+    爆弾で埋まった画面を，左右に動きながらスーパービームで掃射する場面
+    """
+    fill = bench_bombs(game, 3000)
+
+    def tick(game: Game) -> Controls:
+        fill(game)
+        held = [pg.K_LEFT if game.tmr//80%2 else pg.K_RIGHT]
+        if game.tmr%10 == 0:
+            return Controls(held, [pg.K_ESCAPE]*20+[pg.K_SPACE])
+        return Controls(held)
+    return tick
+
+
+BENCH_SCENES = {
+    # 場面名 -> setup：場面を作る関数，phase：計測の間ずっといるはずの場面（Noneなら始めた場面のまま），
+    # actors：計測の終わりに少なくとも残っているはずの敵の数
+    "idle": {"setup": bench_idle, "phase": None, "actors": {}},
+    "enemies": {"setup": bench_enemies, "phase": "wave", "actors": {"Enemy": 500}},
+    "bombs": {"setup": bench_bombs, "phase": "wave", "actors": {}},
+    "boss": {"setup": bench_boss, "phase": "boss", "actors": {"Boss": 1, "S_Boss": 2}},
+    "patterns": {"setup": bench_patterns, "phase": "boss", "actors": {"Boss": 1, "S_Boss": 2}},
+    "charge_sweep": {"setup": bench_charge_sweep, "phase": "wave", "actors": {}},
+}
+
+
+def alloc_count(game: Game) -> int:
+    """
+    戻り値：これまでに新しく確保したSurface・Mask・スプライト・配列の数の合計
+    """
+    return ASSETS.misses+len(ASSETS.masks)+game.shots.allocs+game.shots.ref_allocs
+
+
+def run_bench(name: str, frames: int = 300, warmup: int = 30, render: bool = True, state: bytes = None) -> dict:
+    """
+    ベンチマークの場面を画面を開かずにframesフレーム進め，処理時間などを計る
+    引数1 name：BENCH_SCENESの場面名
+    引数2 frames：計測するフレーム数
+    引数3 warmup：計測前に進めるフレーム数
+    引数4 render：画面外のSurfaceに描画も行うか
+    引数5 state：始める状態のスナップショット（Noneなら最初から，場面はその状態に加える）
+    戻り値：1フレームの時間の平均・95/99パーセンタイル[ms]，確保数，衝突判定の回数などの辞書
+    確保数は計測したフレーム全体（"allocs"，弾が増えていく間にプールが育つ分を含む）と，
+    後半のフレームだけ（"steady"，定常状態なら0）の両方を返す
+    """
+    init_headless()
+    screen = pg.display.get_surface() or pg.display.set_mode((WIDTH, HEIGHT))
+    # 確保数が前に実行した場面で温まったキャッシュに左右されないよう，毎回作り直して先読みした状態から始める
+    ASSETS.clear()
+    ASSETS.preload(ASSET_MANIFEST)
+    bg_img = ASSETS.image("ex05/fig/pg_bg.jpg")
+    game = Game(0)
+    if state is not None:
+        game.restore(state)
+    game.invincible = True  # 爆弾に当たっても終わらない
+    spec = BENCH_SCENES[name]
+    tick = spec["setup"](game) or (lambda game: Controls())
+    # 無敵の戦闘機が爆弾を受けても得点するので，ボス戦にならないようにして場面を保つ
+    phase = game.phase if state is not None or spec["phase"] is None else spec["phase"]
+    if phase == "wave":
+        game.boss_score = math.inf
+    times = []
+    allocs = steady = checks = 0
+    for i in range(warmup+frames):
+        if i == warmup:
+            allocs, checks = alloc_count(game), game.collisions.checks
+            assets = ASSETS.stats()
+        if i == warmup+frames//2:
+            steady = alloc_count(game)
+        start = time.perf_counter_ns()
+        game.step(tick(game))
+        if render:
+            game.draw(screen, bg_img)
+        times.append(time.perf_counter_ns()-start)
+    # 計った処理が場面名どおりのものだったか（場面が変わったり敵が減ったりしていないか）を確かめる
+    counts = game.counts()
+    if game.phase != phase or game.result is not None:
+        raise RuntimeError(f"ベンチマークの場面{name}が計測中に{phase}から{game.phase}（結果：{game.result}）に変わりました")
+    pool = game.shots.stats()
+    short = {kind: counts[kind] for kind, least in spec["actors"].items() if counts[kind] < least}
+    if short:
+        raise RuntimeError(f"ベンチマークの場面{name}の敵が減りました：{short}")
+    times = sorted(times[warmup:])
+    return {
+        "frames": frames,
+        "mean": sum(times)/frames/1e6,
+        "p95": times[min(frames-1, int(frames*0.95))]/1e6,
+        "p99": times[min(frames-1, int(frames*0.99))]/1e6,
+        "allocs": alloc_count(game)-allocs,
+        "steady": alloc_count(game)-steady,
+        "checks": game.collisions.checks-checks,
+        "loads": ASSETS.loads-assets["loads"],  # 計測中にディスクから読んだ回数（先読みしてあれば0）
+        "misses": ASSETS.misses-assets["misses"],  # 計測中にキャッシュになく画像を作った回数
+        **counts,
+        "pool": pool["ref_allocs"],  # 作ったProjectileの数（同時に使った数の最大）
+        "capacity": pool["capacity"],
+    }
+
+
+def bench(names: list[str], frames: int = 300, baseline: str = None, save: bool = False,
+          tolerance: float = 0.25, state: str = None) -> bool:
+    """
+    ベンチマークを実行して結果を表示し，保存した基準値と比べる
+    引数1 names：実行する場面名のリスト
+    引数2 frames：場面ごとに計測するフレーム数
+    引数3 baseline：基準値のJSONファイルのパス
+    引数4 save：結果を基準値として保存するか
+    引数5 tolerance：基準値からの悪化をどこまで許すかの割合
+    引数6 state：始める状態のスナップショットファイルのパス（結果は「場面名@ファイル名」で記録する）
+    戻り値：基準値より悪化した項目がなければTrue
+    """
+    snapshot = load_state(state) if state else None
+    base = {}
+    if baseline and not save and os.path.exists(baseline):
+        with open(baseline) as f:
+            base = json.load(f)
+    results = {}
+    ok = True
+    print(f"{'scene':<14}{'mean':>8}{'p95':>8}{'p99':>8} [ms]{'allocs':>8}{'steady':>8}{'pool':>7}{'checks':>10}")
+    for scene in names:
+        name = f"{scene}@{os.path.basename(state)}" if state else scene
+        r = results[name] = run_bench(scene, frames, state=snapshot)
+        print(f"{name:<14}{r['mean']:8.2f}{r['p95']:8.2f}{r['p99']:8.2f}     {r['allocs']:8}{r['steady']:8}{r['pool']:7}"
+              f"{r['checks']:10}")
+        if r["loads"] or r["misses"]:
+            print(f"  WARNING {name}: {r['loads']} loads and {r['misses']} misses after warm-up")
+        for key in ("mean", "p95", "p99", "allocs", "steady", "checks"):
+            if key in base.get(name, {}) and r[key] > base[name][key]*(1+tolerance):
+                print(f"  REGRESSION {name}.{key}: {r[key]:.2f} > {base[name][key]:.2f} (+{tolerance:.0%})")
+                ok = False
+    if save and baseline:
+        with open(baseline, "w") as f:
+            json.dump(results, f, indent=1)
+    return ok
+
+
+def save_state(game: Game, path: str):
+    """
+    pathが指定されていれば，ゲームの状態のスナップショットをファイルに書き出す
+    """
+    if path:
+        with open(path, "wb") as f:
+            f.write(game.snapshot())
+
+
+def load_state(path: str) -> bytes:
+    """
+    戻り値：save_stateで書き出したスナップショット
+    """
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def save_recording(game: Game, recording: Replay, path: str):
+    """
+    pathが指定されていれば，ゲームの終了時のチェックサムを付けて記録を保存する
+    """
+    if path:
+        recording.checksum = game.checksum()
+        recording.save(path)
+
+
+def save_profile(prof: Profiler, path: str):
+    """
+    pathが指定されていれば，フレームごとの処理時間を書き出す
+    """
+    if path:
+        prof.save(path)
+
+
+def draw_progress(screen: pg.Surface, done: int, total: int, name: str):
+    """
+    起動時の読み込みの進み具合を棒グラフで表示する（1%進むごとに描き直す）
+    """
+    if done*100//total == (done-1)*100//total and done != total:
+        return
+    rect = pg.Rect(0, 0, WIDTH//2, 40)
+    rect.center = WIDTH//2, HEIGHT//2
+    screen.fill((0, 0, 0))
+    pg.draw.rect(screen, (255, 255, 255), rect, 2)
+    pg.draw.rect(screen, (255, 255, 255), (rect.x, rect.y, rect.width*done//total, rect.height))
+    text = ASSETS.font(50).render(f"loading {name}  {done*100//total}%", 1, (255, 255, 255))
+    screen.blit(text, text.get_rect(midbottom=(WIDTH//2, rect.top-20)))
+    pg.display.update()
+    pg.event.pump()  # 読み込み中も応答なしにならないようにする
+
+
+def print_startup(report: dict[str, float]):
+    """
+    起動にかかった時間の内訳を表示する
+    """
+    print(f"startup: {report['total']:.0f}ms ({report['files']} files)")
+    for name, ms in report.items():
+        if name not in ("files", "total"):
+            print(f"  {name:<9}{ms:8.1f}ms")
+
+
+def print_memory(tracker: MemoryTracker):
+    """
+    trackerがあれば，メモリの記録の一覧を表示して記録をやめる
+    """
+    if tracker is not None:
+        tracker.print_report(tracker.report())
+        tracker.stop()
+
+
+def print_assets(stats: dict[str, int], base: dict[str, int]):
+    """
+    baseがあれば，画像の読み込み・キャッシュのヒット・ミスの回数を表示する
+    先読みの後（baseから）にディスクから読んだり画像を作ったりしていたら警告する
+    引数1 stats：Assets.statsの戻り値
+    引数2 base：先読みを終えたときのAssets.statsの戻り値（Noneなら表示しない）
+    """
+    if base is None:
+        return
+    print(f"assets: loads {stats['loads']}  hits {stats['hits']}  misses {stats['misses']}  "
+          f"variants {stats['variants']}")
+    loads, misses = stats["loads"]-base["loads"], stats["misses"]-base["misses"]
+    if loads or misses:
+        print(f"  WARNING: {loads} loads and {misses} misses after warm-up")
+
+
+def print_latency(report: dict[str, dict[str, float]]):
+    """
+    行動ごとの入力の遅れ（押してから処理されるまでと，画面に出るまで）を表示する
+    """
+    if not report:
+        return
+    print("input latency   count  sim p50  sim p95      p50      p95      max [ms]")
+    for name, r in report.items():
+        print(f"  {name:<13}{r['count']:6d}" + "".join(f"{r[k]:9.1f}" for k in ("sim_p50", "sim_p95", "p50", "p95", "max")))
+
+
+def main(tick_rate: int = 50, fps: int = 60, record: str = None, replay: Replay = None,
+         profile: str = None, waves: dict = None, budget: float = None, state: str = None, memory: int = None):
+    """
+    固定ティックでゲームを進め，描画はティックの間を補間して行う
+    描画が間に合わないときは描画を飛ばしてティックだけを進めるので，ゲームの速さは変わらない
+    引数1 tick_rate：1秒あたりのティック数
+    引数2 fps：1秒あたりの最大描画回数
+    引数3 record：入力を記録するリプレイファイルのパス
+    引数4 replay：キーボードの代わりに入力を再生するReplay
+    引数5 profile：フレームごとの処理時間を書き出すCSV/JSONファイルのパス
+    引数6 waves：ウェーブ定義（Noneなら既定のウェーブ）
+    引数7 budget：1フレームの処理時間の予算[ms]（Noneなら1ティックの時間，0なら品質を落とさない）
+    引数8 state：状態のスナップショットファイルのパス（あればその状態から始め，F5キーで今の状態を書き出す）
+    引数9 memory：メモリを記録するティック間隔（Noneなら記録しない，終了時に一覧を表示する）
+    F3キーで処理時間の表示を切り替える
+    BackSpaceキーで2秒前の状態に巻き戻す（記録している入力も巻き戻す）
+    終了時に行動ごとの入力の遅れを表示する
+    """
+    start = time.perf_counter()
+    pg.display.set_caption("こうかとんを撃ち落とす")
+    screen = pg.display.set_mode((WIDTH, HEIGHT))
+    display = (time.perf_counter()-start)*1000
+    report = ASSETS.preload(ASSET_MANIFEST, progress=lambda done, total, name: draw_progress(screen, done, total, name))
+    print_startup({"display": display, **report, "total": display+report["total"]})
+    bg_img = ASSETS.image("ex05/fig/pg_bg.jpg")
+    warm = ASSETS.stats() if profile else None  # 先読みを終えたときの読み込み・ミスの回数（--profileで終了時に比べる）
+    game = Game(replay.seed if replay else None, waves)
+    if state and os.path.exists(state):
+        game.restore(load_state(state))
+    recording = Replay(game.seed, tick_rate)
+    rewind = Rewind(10*tick_rate//5, 5)  # 直近10秒
+    tracker = MemoryTracker(memory) if memory else None
+    if tracker is not None:
+        tracker.start()
+    playback = iter(replay) if replay else None
+    prof = game.prof = Profiler(keep=profile is not None)
+    dirty = DirtyScreen(screen, bg_img)
+    fill_img = pg.Surface((WIDTH, HEIGHT)).convert()  # 品質を落としたときの単色の背景
+    fill_img.fill(pg.transform.average_color(bg_img))
+    governor = Governor(1000/tick_rate if budget is None else budget) if budget != 0 else None
+    dt = 1/tick_rate
+    acc = 0.0  # まだ進めていない経過時間
+    inputs = InputPipeline()
+    last = time.perf_counter()
+
+    while True:
+        prof.begin()
+        now = time.perf_counter()
+        acc = min(acc+now-last, 0.25)  # 大きく遅れたときは追いつくのを諦める
+        last = now
+        for event in inputs.get():
+            if event.type == pg.QUIT:
+                save_recording(game, recording, record)
+                save_profile(prof, profile)
+                print_assets(ASSETS.stats(), warm)
+                print_latency(inputs.report())
+                print_memory(tracker)
+                return 0
+            if event.type == pg.KEYDOWN and event.key == pg.K_F3:
+                prof.show = not prof.show
+            if event.type == pg.KEYDOWN and event.key == pg.K_F5:
+                save_state(game, state)
+            if event.type == pg.KEYDOWN and event.key == pg.K_BACKSPACE and playback is None:
+                recording.truncate(rewind.rewind(game, 2*tick_rate))
+        prof.lap("events")
+
+        while acc >= dt:
+            if playback is not None:
+                controls = next(playback, None)
+                if controls is None:  # 再生し終わった
+                    save_profile(prof, profile)
+                    print_assets(ASSETS.stats(), warm)
+                    print_memory(tracker)
+                    return
+            else:
+                controls = inputs.take()
+            rewind.record(game)
+            recording.record(controls)
+            game.step(controls)
+            if tracker is not None and game.tmr%tracker.interval == 0:
+                tracker.print_sample(tracker.sample(game.tmr))
+            acc -= dt
+            if game.result is not None:
+                save_recording(game, recording, record)
+                save_profile(prof, profile)
+                print_assets(ASSETS.stats(), warm)
+                print_latency(inputs.report())
+                print_memory(tracker)
+                game.draw_result(screen, bg_img)
+                pg.display.update()
+                time.sleep(2)
+                return
+
+        game.draw(dirty, None, acc/dt)
+        counts = game.counts()
+        prof.draw(dirty, counts)
+        prof.lap("profiler")
+        dirty.flush()
+        inputs.shown()
+        prof.lap("flip")
+        if governor is not None:
+            counts["quality"] = governor.level
+        prof.end(counts)
+        if governor is not None and governor.update(prof.frame["total"]/1e6):
+            game.quality = governor.quality
+            dirty.set_background(bg_img if game.quality["background"] else fill_img)
+        # 次の描画まで眠らずにイベントを取り出し続け，押した時刻を正確に残す
+        inputs.wait(now+1/fps)
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="こうかとんを撃ち落とす")
+    parser.add_argument("--headless", type=int, metavar="GAMES",
+                        help="画面を開かずにランダム操作のゲームをGAMES回進め，結果を表示する")
+    parser.add_argument("--workers", type=int, help="--headlessで使うプロセス数")
+    parser.add_argument("--max-ticks", type=int, default=15000, help="--headlessで1ゲームを打ち切るティック数")
+    parser.add_argument("--seed", type=int, default=0, help="--headless，--checkの最初のゲームの乱数の種")
+    parser.add_argument("--record", metavar="PATH", help="遊んだゲームの入力をPATHに記録する")
+    parser.add_argument("--replay", metavar="PATH", help="PATHに記録したゲームを描画なしで最速で再生する")
+    parser.add_argument("--watch", action="store_true", help="--replayのゲームを画面に描画して再生する")
+    parser.add_argument("--check", type=int, metavar="GAMES",
+                        help="GAMES回のゲームを記録して再生し，またスナップショットから続けて，チェックサムが一致するかを調べる")
+    parser.add_argument("--check-ticks", type=int, default=3000, help="--checkで1ゲームを打ち切るティック数")
+    parser.add_argument("--profile", metavar="PATH",
+                        help="フレームごとの処理時間とスプライト数をPATH（.csvまたは.json）に書き出す")
+    parser.add_argument("--bench", nargs="*", metavar="SCENE", choices=list(BENCH_SCENES),
+                        help=f"ベンチマークを実行する（場面：{', '.join(BENCH_SCENES)}，省略するとすべて）")
+    parser.add_argument("--bench-frames", type=int, default=300, help="--benchで場面ごとに計測するフレーム数")
+    parser.add_argument("--bench-baseline", default="bench_baseline.json", metavar="PATH",
+                        help="--benchの結果と比べる基準値のJSONファイル")
+    parser.add_argument("--bench-save", action="store_true", help="--benchの結果を基準値として保存する")
+    parser.add_argument("--bench-tolerance", type=float, default=0.25,
+                        help="--benchで基準値からの悪化をどこまで許すかの割合")
+    parser.add_argument("--budget", type=float, metavar="MS",
+                        help="1フレームの処理時間の予算。超えたら描画の品質を落とす（省略で1ティックの時間，0で無効）")
+    parser.add_argument("--waves", default=WAVES_FILE, metavar="PATH",
+                        help="敵の出現とボス戦を定義したJSONファイル（リプレイは記録時と同じものを使う）")
+    parser.add_argument("--state", metavar="PATH",
+                        help="ゲームの状態のスナップショット。あればその状態から遊び（F5キーで書き出す），"
+                             "--benchの場面もその状態から始める")
+    parser.add_argument("--save-state", metavar="PATH", help="--replayを再生し終えたときの状態をPATHに書き出す")
+    parser.add_argument("--memory", type=int, metavar="TICKS",
+                        help="TICKSティックごとにメモリの使用量と確保した場所，クラスごとのインスタンス数を記録する")
+    parser.add_argument("--soak", type=int, metavar="TICKS",
+                        help="画面を開かずにTICKSティック遊び続け，メモリが増え続けないかを調べる（増え続けたら終了コード1）")
+    parser.add_argument("--soak-render", action="store_true", help="--soakで毎ティック画面外に描画もする")
+    parser.add_argument("--soak-report", metavar="PATH", help="--soakの記録をPATH（JSON）に書き出す")
+    args = parser.parse_args()
+    if args.state and (args.record or args.replay):
+        parser.error("--stateは--record，--replayと一緒には使えません（記録は最初から始めたゲームのみ）")
+    waves = load_waves(args.waves)
+    if args.bench is not None:
+        ok = bench(args.bench or list(BENCH_SCENES), args.bench_frames, args.bench_baseline,
+                   args.bench_save, args.bench_tolerance, args.state)
+        sys.exit(0 if ok else 1)
+    if args.check:
+        ok = check_replays(args.check, args.check_ticks, args.seed, waves)
+        ok = check_snapshots(args.check, args.check_ticks, args.seed, waves) and ok
+        ok = check_pierce(waves) and ok
+        print("check: ok" if ok else "check: FAILED")
+        sys.exit(0 if ok else 1)
+    if args.replay and not args.watch:
+        replay = Replay.load(args.replay)
+        start = time.perf_counter()
+        result = run_replay(replay, waves, args.save_state)
+        elapsed = time.perf_counter()-start
+        print(f"ticks: {result['ticks']}  time: {elapsed:.2f}s  ({result['ticks']/elapsed:.0f} ticks/s)")
+        print(f"score: {result['score']}  result: {result['result']}  match: {result['match']}")
+        sys.exit(0 if result["match"] else 1)
+    if args.soak:
+        start = time.perf_counter()
+        report = run_soak(args.soak, args.memory or 5000, args.seed, args.soak_render, waves)
+        elapsed = time.perf_counter()-start
+        print(f"ticks: {args.soak}  games: {report['games']}  time: {elapsed:.1f}s")
+        MemoryTracker.print_report(report)
+        if args.soak_report:
+            MemoryTracker.save(report, args.soak_report)
+        sys.exit(1 if report["rising"] else 0)
+    if args.headless:
+        start = time.perf_counter()
+        results = run_batch(args.headless, args.workers, args.max_ticks, args.seed, waves)
+        elapsed = time.perf_counter()-start
+        n = len(results)
+        print(f"games: {n}  time: {elapsed:.1f}s  ({n/elapsed*60:.0f} games/min)")
+        print(f"score: mean {sum(r['score'] for r in results)/n:.1f}  max {max(r['score'] for r in results)}")
+        print(f"ticks: mean {sum(r['ticks'] for r in results)/n:.0f}")
+        print(f"boss killed: {sum(r['boss_killed'] for r in results)}/{n}")
+        sys.exit()
     pg.init()
-    main()
+    if args.replay:
+        replay = Replay.load(args.replay)
+        main(replay.tick_rate, replay=replay, profile=args.profile, waves=waves, budget=args.budget,
+             memory=args.memory)
+    else:
+        main(record=args.record, profile=args.profile, waves=waves, budget=args.budget, state=args.state,
+             memory=args.memory)
     pg.quit()
-    sys.exit()
\ No newline at end of file
+    sys.exit()